@@ -8,6 +8,7 @@ import optparse
 import time
 import os
 import sys
+import hashlib
 try:
     import pyfits as pf
 except ImportError:
@@ -21,20 +22,208 @@ try:
 except ImportError:
 	raise Exception('Error: Matplotlib.pyplot is not installed!')
 import numpy as np
+from sfEngine import computeStructureFunction, computeStructureFunctionFFT, \
+                     computeStructureFunctionMC, getStructureFunction, getXAxis, \
+                     getBlockLabels, computeBlockPairTable, computeResampledErrors, \
+                     getCacheKey, buildPairCache, loadPairCache, computeStructureFunctionCached, \
+                     updateStructureFunction
 
 t = time.time()
 
+def getValidPixels(wcs, fdArray, errArray, mask=None):
+    """
+    Returns the RA, Dec, RM, RM error and (y, x) pixel indices of all
+    pixels that are neither blanked in the FD map nor flagged in the
+    optional boolean mask.
+    The sky coordinates of all valid pixels are computed with a single
+    call to the WCS.
+    """
+    # Do not include blanked pixels. Pywcs reads them as nan
+    valid = ~np.isnan(fdArray)
+    if mask is not None:
+        valid &= ~mask
+    decIdx, raIdx = np.nonzero(valid)
+    pixCoords = np.zeros((len(raIdx), wcs.wcs.naxis))
+    pixCoords[:,0] = raIdx
+    pixCoords[:,1] = decIdx
+    skyCoords = wcs.wcs_pix2sky(pixCoords, 0)
+    return skyCoords[:,0], skyCoords[:,1], fdArray[valid], errArray[valid], \
+           (decIdx, raIdx)
+
+def getPixelScale(wcs):
+    """
+    Returns the (Dec, RA) size of a pixel in degrees. The scale is taken
+    from the linear transformation of the WCS, so maps with a CD matrix
+    work as well as maps with CDELTn keywords.
+    """
+    cdelt = wcs.wcs.get_cdelt()
+    pc = wcs.wcs.get_pc()
+    scale = np.sqrt(np.sum(np.square(cdelt[:2,np.newaxis]*pc[:2,:2]), axis=0))
+    return scale[1], scale[0]
+
+def writePlotPoints(fileName, xVal, rmVal, eRMVal, count, stdErr=None):
+    """
+    Writes the structure function to disk.
+    Format: <X Axis value> <binned RM> <binned eRM> <# per bin> [<std. error>]
+    """
+    print 'INFO: Writing structure function to {}'.format(fileName)
+    if stdErr is None:
+        np.savetxt(fileName, np.column_stack((xVal, rmVal, eRMVal, count)), \
+                   fmt=['%f', '%f', '%f', '%d'])
+    else:
+        np.savetxt(fileName, np.column_stack((xVal, rmVal, eRMVal, count, stdErr)), \
+                   fmt=['%f', '%f', '%f', '%d', '%f'])
+
+def getPairCache(options, header, fdArray, errArray, binStart, nBins, binSize):
+    """
+    Returns the memory-mapped pair cache for the given image geometry
+    and bin setup, and the flat indices of the cached pixels. Only the
+    pixels that are not blanked in the input maps are cached, so any
+    further mask can reuse the cache. The cache is built if it does
+    not exist yet.
+    """
+    if not os.path.isdir(options.cacheDir):
+        os.makedirs(options.cacheDir)
+    valid  = np.isfinite(fdArray) & np.isfinite(errArray)
+    pixels = np.flatnonzero(valid)
+    key = getCacheKey(header, fdArray.shape, binStart, nBins, binSize, pixels)
+    cacheFile = os.path.join(options.cacheDir, key+'.pairs')
+    if os.path.exists(cacheFile):
+        print 'INFO: Using the pair cache {}'.format(cacheFile)
+    else:
+        validRA, validDec = getValidPixels(WCS(header), np.where(valid, 0., np.nan), \
+                                           np.zeros(fdArray.shape))[:2]
+        buildPairCache(cacheFile, validRA, validDec, binStart, nBins, binSize, \
+                       int(options.blockSize), int(options.workers), options.useTree)
+    return loadPairCache(cacheFile, len(pixels), nBins), pixels
+
+def getBatchOutName(names):
+    """
+    Returns the structure function file name for a line of the batch
+    file. It is built from the FD map and, if given, the Pol Int map.
+    """
+    parts = [os.path.splitext(os.path.basename(name))[0] for name in names[::2]]
+    return '_'.join(parts)+'.plotPoints.txt'
+
+def getStateKey(header, fdArray, errArray, binStart, nBins, binSize):
+    """
+    Returns a key that identifies the input maps and bin setup of a
+    saved structure function state.
+    """
+    md5 = hashlib.md5(getCacheKey(header, fdArray.shape, binStart, nBins, binSize))
+    md5.update(np.ascontiguousarray(fdArray).tobytes())
+    md5.update(np.ascontiguousarray(errArray).tobytes())
+    return md5.hexdigest()
+
+def computeIncrementalSF(options, wcs, header, fdArray, errArray, pixSel, \
+                         binStart, nBins, binSize):
+    """
+    Computes the structure function of the selected pixels by updating
+    the state saved by a previous run on the same maps. Only pairs with
+    pixels that were added or removed since that run are formed. The
+    new state is saved to options.state.
+    pixSel is (ra, dec, RM, errRM, pixIdx) as returned by getValidPixels.
+    """
+    stateFile = options.state
+    if not stateFile.endswith('.npz'):
+        stateFile += '.npz'
+    key    = getStateKey(header, fdArray, errArray, binStart, nBins, binSize)
+    newPix = np.ravel_multi_index(pixSel[4], fdArray.shape)
+    hist   = None
+    if os.path.exists(stateFile):
+        state = np.load(stateFile)
+        if str(state['key']) == key:
+            print 'INFO: Updating the structure function saved in {}'.format(stateFile)
+            oldPix = state['pixels']
+            hist   = [state['sumRM'], state['sumVar'], state['count']]
+        else:
+            print 'INFO: {} was computed from different maps. Ignoring it.'.format(stateFile)
+    if hist is None:
+        hist = computeStructureFunction(pixSel[0], pixSel[1], pixSel[2], pixSel[3], \
+                                        binStart, nBins, binSize, int(options.blockSize), \
+                                        int(options.workers), options.useTree)
+    else:
+        # Get all pixels that are in either the old or the new pixel set
+        inUnion = np.zeros(fdArray.size, dtype=bool)
+        inUnion[oldPix] = True
+        inUnion[newPix] = True
+        uRA, uDec, uRM, uErrRM, uPixIdx = getValidPixels(wcs, fdArray, errArray, \
+                                          ~inUnion.reshape(fdArray.shape))
+        uPix  = np.ravel_multi_index(uPixIdx, fdArray.shape)
+        inOld = np.in1d(uPix, oldPix)
+        inNew = np.in1d(uPix, newPix)
+        updateStructureFunction(hist, uRA, uDec, uRM, uErrRM, inOld & inNew, \
+                                inOld & ~inNew, inNew & ~inOld, binStart, nBins, \
+                                binSize, int(options.blockSize))
+    print 'INFO: Saving the structure function state to {}'.format(stateFile)
+    np.savez(stateFile, key=key, pixels=newPix, sumRM=hist[0], sumVar=hist[1], \
+             count=hist[2])
+    return hist
+
+def runBatch(options):
+    """
+    Computes the structure function for every map listed in the batch
+    file. Each line lists an FD map, an RM error map and optionally a
+    polarized intensity map used as mask with --threshold. Maps with the
+    same WCS and blanked pixels share one pair cache. Lines that would
+    write the same output file are rejected before any map is processed.
+    """
+    binStart = float(options.binStart)
+    nBins    = int(options.nBins)
+    binSize  = float(options.binSize)
+    xVal     = getXAxis(binStart, nBins, binSize)
+    if options.cacheDir == '':
+        options.cacheDir = 'sfCache'
+    jobs = []
+    for line in open(options.batch):
+        names = line.split()
+        if len(names) == 0 or names[0].startswith('#'): continue
+        if len(names) not in [2, 3]:
+            raise Exception('Invalid line in batch file: {}'.format(line.strip()))
+        jobs.append((names, getBatchOutName(names)))
+    outNames = [outName for names, outName in jobs]
+    for outName in set(outNames):
+        if outNames.count(outName) > 1:
+            raise Exception('Several lines of the batch file would write to {}. '.format(outName)+\
+                            'Rename the input maps to make the outputs unique.')
+    for names, outName in jobs:
+        print 'INFO: Processing {}'.format(' '.join(names))
+        try:
+            fdImage  = pf.open(names[0])
+            errArray = np.squeeze(pf.open(names[1])[0].data)
+        except: raise Exception('Unable to read the input images')
+        fdArray = np.array(np.squeeze(fdImage[0].data), dtype=np.float64)
+        header  = fdImage[0].header
+        fdImage.close()
+        if fdArray.shape != errArray.shape:
+            raise Exception('Input images have different shape')
+        # The pair cache does not depend on the Pol Int mask
+        pairs, pixels = getPairCache(options, header, fdArray, errArray, binStart, \
+                                     nBins, binSize)
+        if len(names) == 3:
+            if options.threshold == '':
+                raise Exception('A threshold must be specified to use {} as mask'.format(names[2]))
+            iArray = np.squeeze(pf.open(names[2])[0].data)
+            fdArray[iArray < float(options.threshold)] = np.nan
+        sumRM, sumVar, count = computeStructureFunctionCached(pairs, fdArray.ravel()[pixels], \
+                               errArray.ravel()[pixels], nBins)
+        rmVal, eRMVal = getStructureFunction(sumRM, sumVar, count)
+        writePlotPoints(outName, xVal, rmVal, eRMVal, count)
+
 def main(options):
     
+    if options.batch != '':
+        runBatch(options)
+        return
+    
     # Some filenames used within the script
     maskedImFile       = 'maskedFD.FITS'
-    validPixelFileName = 'validPixelList.txt'
     maskedRMErrMap     = 'maskedRMErrorMap.FITS'
-    plotValsFromC      = 'plotPoints.txt'
+    plotValsFile       = 'plotPoints.txt'
     
     # Remove all temp files from previous execution
     print 'INFO: Cleaning up the workspace'
-    os.system('rm {} {} {} {}'.format(maskedImFile, validPixelFileName, maskedRMErrMap, plotValsFromC))
+    os.system('rm {} {} {}'.format(maskedImFile, maskedRMErrMap, plotValsFile))
     
     if options.fdImage == '':
         raise Exception('Faraday Depth image was not specified.')
@@ -52,19 +241,11 @@ def main(options):
         errArray= np.squeeze(errImage[0].data)
         header  = fdImage[0].header
         fdImage.close()
-        # Loop over each pixel and get the sky coordinates
+        # Get the sky coordinates of all non-blanked pixels
         wcs     = WCS(header)
         decSize, raSize = fdArray.shape
-        tempRA = []; dec = []; RM = []; errRM = []
-        for j in range(raSize):
-            for i in range(decSize):
-            	# Do not include blanked pixels. Pywcs reads them as nan
-            	if str(fdArray[i,j]) == 'nan': continue
-            	else:
-                    tempRA.append(wcs.wcs_pix2sky([[j,i,0]], 0)[0][0])
-                    dec.append   (wcs.wcs_pix2sky([[j,i,0]], 0)[0][1])
-                    RM.append    (fdArray[i,j])
-                    errRM.append (errArray[i,j])
+        mask    = None
+        tempRA, dec, RM, errRM, pixIdx = getValidPixels(wcs, fdArray, errArray)
         nValidPixels = len(dec)
     else:
         # Use Pol Int image to select valid pixels
@@ -79,28 +260,20 @@ def main(options):
         header  = fdImage[0].header
         print fdArray.shape
         #Initialize a new array which will be updated as per the mask
-        maskedIm= np.squeeze(fdImage[0].data)
-        maskerrRM = np.squeeze(errImage[0].data)
+        maskedIm= np.array(fdArray)
+        maskerrRM = np.array(errArray)
         print maskedIm.shape
         # Check if the input images have the same shape
         if fdArray.shape != iArray.shape:
             raise Exception('Input images have different shape')
         wcs    = WCS(header)
         decSize, raSize = fdArray.shape
-        tempRA = []; dec = []; RM = []; errRM = []
-        nValidPixels = 0
-        for j in range(raSize):
-            for i in range(decSize):
-                if iArray[i,j] < float(options.threshold):
-                    maskedIm[i,j] = np.nan
-                    maskerrRM[i,j] = np.nan
-                elif str(fdArray[i,j]) == 'nan': continue
-                else:
-                    tempRA.append(wcs.wcs_pix2sky([[j,i,0]], 0)[0][0])
-                    dec.append   (wcs.wcs_pix2sky([[j,i,0]], 0)[0][1])
-                    RM.append    (fdArray[i,j])
-                    errRM.append (errArray[i,j])
-                    nValidPixels += 1
+        # Blank the pixels that fall below the threshold
+        mask = iArray < float(options.threshold)
+        maskedIm[mask]  = np.nan
+        maskerrRM[mask] = np.nan
+        tempRA, dec, RM, errRM, pixIdx = getValidPixels(wcs, fdArray, errArray, mask)
+        nValidPixels = len(dec)
         print 'INFO: Selected {:} of {:} pixels'.format(nValidPixels, raSize*decSize)
         # Write out the masked image to disk
         print 'INFO: Writing out the masked to disk'
@@ -110,39 +283,80 @@ def main(options):
         hdu.writeto(maskedRMErrMap)
     # If this data set is from WSRT, add 360 to RA
     if options.isWSRT:
-        ra = [val+360. for val in tempRA]
+        ra = tempRA + 360.
     else:
         ra = tempRA
     
-    # Write (ra, dec, RM, eRM) to disk
-    tempFile = open(validPixelFileName, 'w')
-    for i in range(len(ra)):
-        tempFile.write('{:.5f} {:.5f} {:.5f} {:.5f}\n'.format(ra[i], dec[i], RM[i], errRM[i]))
-    tempFile.close()
-    
     # Get the resolution of the input images
     bmaj = float(header['BMAJ'])*3600.
     bmin = float(header['BMIN'])*3600.
     print 'INFO: Resolution of the input image: {:.2f} arcsec by {:.2f} arcsec'.format(bmaj, bmin)
     
-    # Pass the pixel list and the number of entries to the C code
-    os.system('./computeStructureFunction {:} {:} {} {} {} {}'.format(\
-              validPixelFileName, nValidPixels, options.binStart,  \
-              options.nBins, options.binSize, plotValsFromC))
-
-    # Read the plot points returned by C
-    xVal = []; diffVal = []; rmVal = []; eRMVal = []
-    for line in open(plotValsFromC, "r"):
-    	xVal.append   (float(line.split()[0]))
-    	rmVal.append  (float(line.split()[1]))
-    	eRMVal.append (float(line.split()[2]))
-    xVal   = np.asarray(xVal)
-    rmVal  = np.asarray(rmVal)
-    eRMVal = np.asarray(eRMVal)
+    # Compute the structure function from the list of valid pixels
+    binStart = float(options.binStart)
+    nBins    = int(options.nBins)
+    binSize  = float(options.binSize)
+    stdErr   = None
+    if options.useFFT:
+        print 'INFO: Computing the structure function using FFTs'
+        pixScale = getPixelScale(wcs)
+        sumRM, sumVar, count = computeStructureFunctionFFT(fdArray, errArray, \
+                               mask, pixScale, binStart, nBins, binSize)
+    elif options.useMC:
+        print 'INFO: Estimating the structure function from random pixel pairs'
+        pixScale = getPixelScale(wcs)
+        seed = None if options.seed == '' else int(options.seed)
+        sumRM, sumVar, count, stdErr = computeStructureFunctionMC(fdArray, \
+                               errArray, mask, pixScale, binStart, nBins, binSize, \
+                               float(options.relErr), int(float(options.maxPairs)), \
+                               seed=seed)
+    elif options.state != '':
+        sumRM, sumVar, count = computeIncrementalSF(options, wcs, header, fdArray, \
+                               errArray, (ra, dec, RM, errRM, pixIdx), binStart, \
+                               nBins, binSize)
+    elif options.cacheDir != '':
+        pairs, pixels = getPairCache(options, header, fdArray, errArray, binStart, \
+                                     nBins, binSize)
+        fdMasked = np.array(fdArray, dtype=np.float64)
+        if mask is not None:
+            fdMasked[mask] = np.nan
+        sumRM, sumVar, count = computeStructureFunctionCached(pairs, fdMasked.ravel()[pixels], \
+                               errArray.ravel()[pixels], nBins)
+    else:
+        sumRM, sumVar, count = computeStructureFunction(ra, dec, RM, errRM, \
+                               binStart, nBins, binSize, int(options.blockSize), \
+                               int(options.workers), options.useTree)
+    xVal = getXAxis(binStart, nBins, binSize)
+    rmVal, eRMVal = getStructureFunction(sumRM, sumVar, count)
+    
+    # Estimate the uncertainties by resampling beam-sized blocks of pixels
+    if int(options.nBoot) > 0 or options.jackknife:
+        beamPix = max(bmaj, bmin)/3600./min(getPixelScale(wcs))
+        labels, nLabels = getBlockLabels(pixIdx[0], pixIdx[1], beamPix, \
+                                         int(options.bootBlocks))
+        table = computeBlockPairTable(ra, dec, RM, errRM, labels, nLabels, \
+                                      binStart, nBins, binSize, int(options.blockSize), \
+                                      int(options.workers), options.useTree)
+        seed = None if options.seed == '' else int(options.seed)
+        stdErr = computeResampledErrors(table, int(options.nBoot), options.jackknife, \
+                                        int(options.workers), seed)
+    
+    # Write structure function to disk
+    if stdErr is not None:
+        print 'INFO: Bin\t# pairs\tStructure function\tStd. error'
+        for i in range(nBins):
+            print 'INFO: {:.2f}\t{}\t{:f}\t{:f}'.format(xVal[i], count[i], \
+                  rmVal[i]-eRMVal[i], stdErr[i])
+    writePlotPoints(plotValsFile, xVal, rmVal, eRMVal, count, stdErr)
+    
     diffVal= np.absolute(np.subtract(rmVal, eRMVal))
     
     # Plot
-    plt.plot(xVal, np.log10(diffVal), 'bo', label="My code")
+    if stdErr is None:
+        plt.plot(xVal, np.log10(diffVal), 'bo', label="My code")
+    else:
+        plt.errorbar(xVal, np.log10(diffVal), yerr=stdErr/(diffVal*np.log(10.)), \
+                     fmt='bo', label="My code")
     plt.xlabel('Angular distance (deg)')
     plt.ylabel('Structure function')
     plt.savefig('output.png')
@@ -159,6 +373,36 @@ opt.add_option('-w', '--isWSRT', help='Enable this flag to indicate the data is
 opt.add_option('-b', '--binStart', help='Minimum value to start binning [default:-2.5]', default='-2.5')
 opt.add_option('-n', '--nBins', help='No of bins [default: 20]', default='20')
 opt.add_option('-s', '--binSize', help='Size of a bin [default: 0.1]', default='0.1')
+opt.add_option('--blockSize', help='No. of pixels per block of pixel pairs [default: 2048]', \
+               default='2048')
+opt.add_option('-j', '--workers', help='No. of worker processes used to bin the pixel pairs '+\
+               '[default: 1]', default='1')
+opt.add_option('-k', '--useTree', help='Use a KD-tree to only form pixel pairs within the '+\
+               'bin range [default: False]', default=False, action='store_true')
+opt.add_option('--useFFT', help='Compute the structure function of the pixel grid using '+\
+               'FFTs (flat-sky approximation) [default: False]', default=False, \
+               action='store_true')
+opt.add_option('--useMC', help='Estimate the structure function from randomly drawn pixel '+\
+               'pairs [default: False]', default=False, action='store_true')
+opt.add_option('--relErr', help='Relative error per bin at which to stop drawing pairs '+\
+               '[default: 0.05]', default='0.05')
+opt.add_option('--maxPairs', help='Maximum number of random pairs to draw [default: 1e8]', \
+               default='1e8')
+opt.add_option('--nBoot', help='No. of bootstrap replicates used to estimate the errors '+\
+               '[default: 0]', default='0')
+opt.add_option('--jackknife', help='Estimate the errors with a delete-one-block jackknife '+\
+               '[default: False]', default=False, action='store_true')
+opt.add_option('--bootBlocks', help='Maximum number of beam-sized pixel blocks to resample. '+\
+               'Each worker holds 24*bootBlocks^2*nBins bytes [default: 400]', default='400')
+opt.add_option('--cacheDir', help='Directory to cache the pixel pair geometry in '+\
+               '[default: no cache, sfCache in batch mode]', default='')
+opt.add_option('--batch', help='Text file listing one "<FD map> <RM error map> '+\
+               '[<Pol Int map>]" per line to process with a shared pair cache '+\
+               '[no default]', default='')
+opt.add_option('--state', help='File to save the binned sums and pixel set in. If it exists '+\
+               'and was computed from the same maps, only pairs with added or removed '+\
+               'pixels are formed [no default]', default='')
+opt.add_option('--seed', help='Seed for the random number generator [no default]', default='')
 options, arguments = opt.parse_args()
 main(options)
 
@@ -0,0 +1,684 @@
+#!/usr/bin/env python
+"""
+sfEngine.py
+
+In-process engine for computing the RM structure function from a list
+of valid pixels. Pixel pairs are processed in square blocks and binned
+straight into the log-distance histogram, so memory scales with the
+number of pixels and bins rather than with the number of pairs.
+
+The binning follows computeStructureFunction.c: a pair with angular
+distance d (in deg) goes into bin round((log10(d) - binStart)/binSize).
+"""
+import os
+import hashlib
+from multiprocessing import Pool
+try:
+    import numpy as np
+except ImportError:
+    raise Exception('Unable to import Numpy.')
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+def getUnitVectors(ra, dec):
+    """
+    Converts (ra, dec) in degrees into unit vectors on the sphere.
+    """
+    raRad  = np.radians(np.asarray(ra, dtype=np.float64))
+    decRad = np.radians(np.asarray(dec, dtype=np.float64))
+    vec = np.empty((len(raRad), 3))
+    vec[:,0] = np.cos(raRad)*np.cos(decRad)
+    vec[:,1] = np.sin(raRad)*np.cos(decRad)
+    vec[:,2] = np.sin(decRad)
+    return vec
+
+def getXAxis(binStart, nBins, binSize):
+    """
+    Returns the x-axis values for a given histogram setup.
+    """
+    return np.arange(nBins)*binSize + binStart - binSize/2.
+
+def getBinIndex(cosDist, binStart, nBins, binSize):
+    """
+    Returns the bin index for an array of cosines of angular distances.
+    Pairs that fall outside the bin range are assigned -1.
+    """
+    angDist = np.degrees(np.arccos(np.clip(cosDist, -1., 1.)))
+    return getDistBinIndex(angDist, binStart, nBins, binSize)
+
+def getDistBinIndex(angDist, binStart, nBins, binSize):
+    """
+    Returns the bin index for an array of angular distances in deg.
+    Pairs that fall outside the bin range are assigned -1.
+    """
+    with np.errstate(divide='ignore'):
+        angLogDist = np.log10(angDist)
+    binIdx = np.floor((angLogDist - binStart)/binSize + 0.5)
+    binIdx[~np.isfinite(binIdx)] = -1
+    binIdx[(binIdx < 0) | (binIdx >= nBins)] = -1
+    return binIdx.astype(np.int64)
+
+def iterBlocks(nPixels, blockSize):
+    """
+    Yields (iStart, iStop, jStart, jStop) for all blocks that cover the
+    upper triangle of the nPixels x nPixels pair matrix.
+    """
+    for iStart in range(0, nPixels, blockSize):
+        iStop = min(iStart+blockSize, nPixels)
+        for jStart in range(iStart, nPixels, blockSize):
+            yield iStart, iStop, jStart, min(jStart+blockSize, nPixels)
+
+def getBlockPairs(vec, binParams, block):
+    """
+    Returns the flat pixel indices and bin indices of all pairs in a
+    block that fall within the bin range.
+    """
+    iStart, iStop, jStart, jStop = block
+    binIdx = getBinIndex(np.dot(vec[iStart:iStop], vec[jStart:jStop].T),
+                         *binParams)
+    if iStart == jStart:
+        # Only keep pairs above the diagonal in the diagonal blocks
+        binIdx[np.tril_indices(iStop-iStart, 0, jStop-jStart)] = -1
+    iIdx, jIdx = np.nonzero(binIdx >= 0)
+    return iIdx+iStart, jIdx+jStart, binIdx[iIdx, jIdx]
+
+def iterRowBlocks(nPixels, blockSize):
+    """
+    Yields (iStart, iStop) for blocks of consecutive pixels.
+    """
+    for iStart in range(0, nPixels, blockSize):
+        yield iStart, min(iStart+blockSize, nPixels)
+
+def getMaxChord(binStart, nBins, binSize):
+    """
+    Returns the chord length on the unit sphere corresponding to the
+    upper edge of the last bin, padded slightly so that no pair falling
+    inside the bin range is missed due to round-off.
+    """
+    maxAngDist = np.radians(10**(binStart + (nBins-0.5)*binSize))
+    return 2*np.sin(min(maxAngDist, np.pi)/2.)*(1+1.E-6)
+
+def getTreePairs(vec, tree, binParams, block):
+    """
+    Returns the flat pixel indices and bin indices of all pairs whose
+    first pixel lies in the block and that fall within the bin range.
+    Only pairs closer than the largest bin are enumerated using the
+    KD-tree built on the unit vectors of all pixels.
+    """
+    iStart, iStop = block
+    blockTree = cKDTree(vec[iStart:iStop])
+    pairs = blockTree.sparse_distance_matrix(tree, getMaxChord(*binParams),
+                                             output_type='ndarray')
+    iIdx = pairs['i'].astype(np.int64) + iStart
+    jIdx = pairs['j'].astype(np.int64)
+    keep = jIdx > iIdx
+    iIdx, jIdx = iIdx[keep], jIdx[keep]
+    binIdx = getBinIndex(np.einsum('ij,ij->i', vec[iIdx], vec[jIdx]),
+                         *binParams)
+    keep = binIdx >= 0
+    return iIdx[keep], jIdx[keep], binIdx[keep]
+
+def binPairs(rm, var, nBins, pairs):
+    """
+    Bins a list of pairs (iIdx, jIdx, binIdx) and returns the partial
+    histogram (sumRM, sumVar, count).
+    """
+    iIdx, jIdx, binIdx = pairs
+    return [np.bincount(binIdx, weights=np.square(rm[iIdx]-rm[jIdx]),
+                        minlength=nBins),
+            np.bincount(binIdx, weights=var[iIdx]+var[jIdx],
+                        minlength=nBins),
+            np.bincount(binIdx, minlength=nBins).astype(np.int64)]
+
+def binBlock(vec, rm, var, binParams, block, tree=None):
+    """
+    Bins all pairs in a block and returns the partial histogram
+    (sumRM, sumVar, count) of this block. If a KD-tree is given, the
+    block is a range of pixels from iterRowBlocks, else a tile of the
+    pair matrix from iterBlocks.
+    """
+    return binPairs(rm, var, binParams[1], getPairs(vec, binParams, block, tree))
+
+def getPairs(vec, binParams, block, tree=None):
+    """
+    Returns the pairs (iIdx, jIdx, binIdx) of a block using either the
+    brute-force or the KD-tree pair search.
+    """
+    if tree is None:
+        return getBlockPairs(vec, binParams, block)
+    return getTreePairs(vec, tree, binParams, block)
+
+def newHistogram(nBins):
+    """
+    Returns an empty (sumRM, sumVar, count) histogram.
+    """
+    return [np.zeros(nBins), np.zeros(nBins), np.zeros(nBins, dtype=np.int64)]
+
+def addHistogram(hist, partHist):
+    """
+    Adds a partial histogram to hist in place.
+    """
+    for total, part in zip(hist, partHist):
+        total += part
+    return hist
+
+# Pixel data shared with the worker processes
+workerData = {}
+
+def initWorker(vec, rm, var, binParams, useTree, labels=None):
+    """
+    Stores the pixel data in each worker process of the pool.
+    """
+    workerData['args'] = (vec, rm, var, binParams)
+    workerData['tree'] = cKDTree(vec) if useTree else None
+    workerData['labels'] = labels
+
+def binWorkerBlock(block):
+    """
+    Bins a block using the pixel data stored by initWorker.
+    """
+    return binBlock(*(workerData['args']+(block, workerData['tree'])))
+
+def getValidInputs(ra, dec, rm, erm):
+    """
+    Drops pixels with non-finite values and returns the unit vectors,
+    RM and variance of the remaining pixels along with the boolean
+    array of retained pixels.
+    """
+    ra, dec  = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    rm, erm  = np.asarray(rm, dtype=np.float64), np.asarray(erm, dtype=np.float64)
+    valid = np.isfinite(ra) & np.isfinite(dec) & np.isfinite(rm) & np.isfinite(erm)
+    return getUnitVectors(ra[valid], dec[valid]), rm[valid], np.square(erm[valid]), valid
+
+def computeStructureFunction(ra, dec, rm, erm, binStart, nBins, binSize,
+                             blockSize=2048, workers=1, useTree=False):
+    """
+    Computes the binned sums of squared RM difference, summed RM error
+    variance and number of pairs for all pixel pairs.
+    Returns (sumRM, sumVar, count), each of length nBins.
+
+    With workers > 1, the blocks are distributed over a process pool.
+    The partial histograms are always added in block order, so the
+    result is identical to the serial computation.
+
+    With useTree, pairs are searched with a KD-tree on the unit sphere
+    so that only pairs within the bin range are formed.
+    """
+    vec, rm, var, valid = getValidInputs(ra, dec, rm, erm)
+    binParams = (float(binStart), int(nBins), float(binSize))
+    hist = newHistogram(binParams[1])
+    nPixels = len(rm)
+    if useTree:
+        if cKDTree is None:
+            raise Exception('Unable to import Scipy. KD-tree search is not available.')
+        print 'INFO: Forming correlations within {:.5f} deg using a KD-tree.'.\
+              format(10**(binParams[0] + (binParams[1]-0.5)*binParams[2]))
+        blocks = iterRowBlocks(nPixels, blockSize)
+    else:
+        print 'INFO: Forming {} correlations.'.format(nPixels*(nPixels-1)/2)
+        blocks = iterBlocks(nPixels, blockSize)
+    if workers > 1:
+        print 'INFO: Binning pixel pairs using {} workers.'.format(workers)
+        pool = Pool(workers, initializer=initWorker,
+                    initargs=(vec, rm, var, binParams, useTree))
+        try:
+            for partHist in pool.imap(binWorkerBlock, blocks):
+                addHistogram(hist, partHist)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tree = cKDTree(vec) if useTree else None
+        for block in blocks:
+            addHistogram(hist, binBlock(vec, rm, var, binParams, block, tree))
+    print 'INFO: {} valid values were used for binning.'.format(hist[2].sum())
+    return hist
+
+def computeCrossHistogram(vec1, rm1, var1, vec2, rm2, var2, binParams,
+                          blockSize=2048):
+    """
+    Returns the (sumRM, sumVar, count) histogram of all pairs with one
+    pixel from each of two disjoint sets of pixels.
+    """
+    vec = np.concatenate((vec1, vec2))
+    rm  = np.concatenate((rm1, rm2))
+    var = np.concatenate((var1, var2))
+    hist = newHistogram(binParams[1])
+    n1 = len(rm1)
+    for iStart, iStop in iterRowBlocks(n1, blockSize):
+        for jStart, jStop in iterRowBlocks(len(rm2), blockSize):
+            block = (iStart, iStop, jStart+n1, jStop+n1)
+            addHistogram(hist, binBlock(vec, rm, var, binParams, block))
+    return hist
+
+def updateStructureFunction(hist, ra, dec, rm, erm, kept, removed, added,
+                            binStart, nBins, binSize, blockSize=2048):
+    """
+    Updates a (sumRM, sumVar, count) histogram in place when pixels are
+    added to or removed from the set it was computed from. kept, removed
+    and added are boolean arrays selecting the pixels of ra, dec, rm and
+    erm that are in both sets, only in the old set and only in the new
+    set. Only the pairs involving removed or added pixels are formed.
+    """
+    vec, rm, var, valid = getValidInputs(ra, dec, rm, erm)
+    kept, removed, added = kept[valid], removed[valid], added[valid]
+    binParams = (float(binStart), int(nBins), float(binSize))
+    print 'INFO: Updating the structure function with {} added and {} removed pixels.'.\
+          format(added.sum(), removed.sum())
+    for sign, change in [(-1, removed), (1, added)]:
+        if not change.any(): continue
+        vecChange, rmChange, varChange = vec[change], rm[change], var[change]
+        cross  = computeCrossHistogram(vecChange, rmChange, varChange,
+                                       vec[kept], rm[kept], var[kept], binParams,
+                                       blockSize)
+        within = newHistogram(binParams[1])
+        for block in iterBlocks(len(rmChange), blockSize):
+            addHistogram(within, binBlock(vecChange, rmChange, varChange,
+                                          binParams, block))
+        for total, part1, part2 in zip(hist, cross, within):
+            total += sign*(part1 + part2)
+    return hist
+
+def getBlockLabels(yIdx, xIdx, blockPix, maxBlocks):
+    """
+    Groups pixels into square spatial blocks of at least blockPix pixels
+    on a side. The block size is increased until there are at most
+    maxBlocks blocks. Returns the block label (0 to nBlocks-1) of every
+    pixel and the number of blocks.
+    """
+    blockPix = max(int(np.ceil(blockPix)), 1)
+    while True:
+        blockId = (np.asarray(yIdx)//blockPix)*(np.max(xIdx)//blockPix + 1) + \
+                  np.asarray(xIdx)//blockPix
+        uniqIds, labels = np.unique(blockId, return_inverse=True)
+        if len(uniqIds) <= maxBlocks:
+            return labels, len(uniqIds)
+        blockPix = int(np.ceil(blockPix*1.25))
+
+def binPairsToTable(rm, var, labels, nLabels, nBins, pairs, table):
+    """
+    Adds a list of pairs (iIdx, jIdx, binIdx) to the block-pair table.
+    The table has shape (3, nLabels*nLabels*nBins) and holds the sums of
+    squared RM difference, summed variance and number of pairs for every
+    combination of block labels (smallest label first) and bin.
+    """
+    iIdx, jIdx, binIdx = pairs
+    iLab, jLab = labels[iIdx], labels[jIdx]
+    key = (np.minimum(iLab, jLab)*nLabels + np.maximum(iLab, jLab))*nBins + binIdx
+    size = table.shape[1]
+    table[0] += np.bincount(key, weights=np.square(rm[iIdx]-rm[jIdx]), minlength=size)
+    table[1] += np.bincount(key, weights=var[iIdx]+var[jIdx], minlength=size)
+    table[2] += np.bincount(key, minlength=size)
+    return table
+
+def binTableBlocks(vec, rm, var, labels, nLabels, binParams, blocks, tree=None):
+    """
+    Returns the block-pair table for all pairs in a list of blocks.
+    """
+    table = np.zeros((3, nLabels*nLabels*binParams[1]))
+    for block in blocks:
+        binPairsToTable(rm, var, labels, nLabels, binParams[1],
+                        getPairs(vec, binParams, block, tree), table)
+    return table
+
+def binWorkerTable(blocks):
+    """
+    Bins a list of blocks into a block-pair table using the pixel data
+    stored by initWorker.
+    """
+    vec, rm, var, binParams = workerData['args']
+    labels, nLabels = workerData['labels']
+    return binTableBlocks(vec, rm, var, labels, nLabels, binParams, blocks,
+                          workerData['tree'])
+
+def computeBlockPairTable(ra, dec, rm, erm, labels, nLabels, binStart, nBins,
+                          binSize, blockSize=2048, workers=1, useTree=False):
+    """
+    Computes the binned structure function sums separately for every
+    pair of spatial blocks given by labels. Returns an array of shape
+    (3, nLabels, nLabels, nBins) holding the sums of squared RM
+    difference, summed variance and number of pairs. Only entries with
+    the first label not larger than the second are used.
+    Resampled structure functions can be computed from this table by
+    reweighting the blocks, without forming the pixel pairs again.
+    The table takes 24*nLabels**2*nBins bytes, about 77 MB for 400
+    blocks and 20 bins, and every worker process holds a copy.
+    """
+    vec, rm, var, valid = getValidInputs(ra, dec, rm, erm)
+    labels = np.asarray(labels)[valid]
+    binParams = (float(binStart), int(nBins), float(binSize))
+    nPixels = len(rm)
+    if useTree and cKDTree is None:
+        raise Exception('Unable to import Scipy. KD-tree search is not available.')
+    if useTree:
+        blocks = list(iterRowBlocks(nPixels, blockSize))
+    else:
+        blocks = list(iterBlocks(nPixels, blockSize))
+    print 'INFO: Binning pixel pairs of {} spatial blocks.'.format(nLabels)
+    if workers > 1:
+        pool = Pool(workers, initializer=initWorker,
+                    initargs=(vec, rm, var, binParams, useTree, (labels, nLabels)))
+        try:
+            # Every worker keeps its own table for an interleaved share of blocks
+            tables = pool.map(binWorkerTable,
+                              [blocks[i::workers] for i in range(workers)])
+        finally:
+            pool.close()
+            pool.join()
+        table = np.sum(tables, axis=0)
+    else:
+        tree = cKDTree(vec) if useTree else None
+        table = binTableBlocks(vec, rm, var, labels, nLabels, binParams, blocks, tree)
+    return table.reshape((3, nLabels, nLabels, binParams[1]))
+
+def getReplicateHistogram(table, weights):
+    """
+    Returns the (sumRM, sumVar, count) histogram of a block-pair table
+    in which every block is weighted by weights. Pairs between two
+    blocks get the product of the block weights; pairs within a block
+    get the block weight.
+    """
+    pairWeights = np.triu(np.outer(weights, weights), 1)
+    pairWeights[np.diag_indices_from(pairWeights)] = weights
+    return np.tensordot(pairWeights, table, axes=([0, 1], [1, 2]))
+
+def getReplicateSF(weights):
+    """
+    Returns the structure function of one resampled replicate using the
+    block-pair table stored by initWorker.
+    """
+    sumRM, sumVar, count = getReplicateHistogram(workerData['table'], weights)
+    rmVal, eRMVal = getStructureFunction(sumRM, sumVar, count)
+    return rmVal - eRMVal
+
+def initReplicateWorker(table):
+    """
+    Stores the block-pair table in each worker process of the pool.
+    """
+    workerData['table'] = table
+
+def computeResampledErrors(table, nBoot=100, jackknife=False, workers=1,
+                           seed=None):
+    """
+    Computes the standard error of the structure function in each bin
+    by resampling the spatial blocks of a block-pair table, either with
+    nBoot bootstrap replicates or with a delete-one-block jackknife.
+    Bins with fewer than two finite replicates get no error. Every
+    worker process holds a copy of the table.
+    """
+    nLabels = table.shape[1]
+    if jackknife:
+        weightList = [np.ones(nLabels) for i in range(nLabels)]
+        for i, weights in enumerate(weightList):
+            weights[i] = 0.
+    else:
+        rng = np.random.RandomState(seed)
+        weightList = [rng.multinomial(nLabels, np.ones(nLabels)/nLabels).astype(np.float64)
+                      for i in range(nBoot)]
+    print 'INFO: Computing {} resampled structure functions.'.format(len(weightList))
+    if workers > 1:
+        pool = Pool(workers, initializer=initReplicateWorker, initargs=(table,))
+        try:
+            replicates = np.asarray(pool.map(getReplicateSF, weightList))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        initReplicateWorker(table)
+        replicates = np.asarray([getReplicateSF(weights) for weights in weightList])
+    stdErr = np.nan*np.ones(replicates.shape[1])
+    enough = np.isfinite(replicates).sum(axis=0) > 1
+    if jackknife:
+        stdErr[enough] = np.sqrt((nLabels-1.)*np.nanvar(replicates[:, enough], axis=0))
+    else:
+        stdErr[enough] = np.nanstd(replicates[:, enough], axis=0, ddof=1)
+    return stdErr
+
+def getPairDtype(nPixels, nBins):
+    """
+    Returns the record layout of the on-disk pair cache. The smallest
+    unsigned types that hold the pixel and bin indices are used.
+    """
+    idxType = '<u2' if nPixels <= 2**16 else '<u4'
+    binType = '<u1' if nBins <= 2**8 else '<u2'
+    return np.dtype([('i', idxType), ('j', idxType), ('bin', binType)])
+
+def getCacheKey(header, shape, binStart, nBins, binSize, pixels=None):
+    """
+    Returns a key that identifies the pair geometry of an image from
+    its celestial WCS keywords, image shape and bin setup. pixels are
+    the flat indices of the cached pixels, if not all pixels are cached.
+    """
+    wcsKeys = ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+               'CDELT1', 'CDELT2', 'CROTA1', 'CROTA2', 'CD1_1', 'CD1_2',
+               'CD2_1', 'CD2_2', 'PC1_1', 'PC1_2', 'PC2_1', 'PC2_2',
+               'PV2_1', 'PV2_2', 'LONPOLE', 'LATPOLE', 'EQUINOX', 'RADESYS']
+    desc = [(key, header.get(key)) for key in wcsKeys]
+    desc += [tuple(shape), float(binStart), int(nBins), float(binSize)]
+    md5 = hashlib.md5(repr(desc))
+    if pixels is not None:
+        md5.update(np.ascontiguousarray(pixels, dtype='<i8').tobytes())
+    return md5.hexdigest()
+
+def getWorkerPairs(block):
+    """
+    Returns the pairs of a block using the pixel data stored by initWorker.
+    """
+    vec, rm, var, binParams = workerData['args']
+    return getPairs(vec, binParams, block, workerData['tree'])
+
+def buildPairCache(cacheFile, ra, dec, binStart, nBins, binSize,
+                   blockSize=2048, workers=1, useTree=False):
+    """
+    Writes the indices into ra/dec and the bin index of every pixel pair
+    within the bin range to cacheFile. Only the pixels that can be valid
+    should be passed, since the cache grows with the square of their
+    number. Returns the number of cached pairs.
+    """
+    vec = getUnitVectors(ra, dec)
+    binParams = (float(binStart), int(nBins), float(binSize))
+    pairDtype = getPairDtype(len(vec), nBins)
+    if useTree and cKDTree is None:
+        raise Exception('Unable to import Scipy. KD-tree search is not available.')
+    if useTree:
+        blocks = iterRowBlocks(len(vec), blockSize)
+    else:
+        blocks = iterBlocks(len(vec), blockSize)
+    print 'INFO: Writing the pair geometry of {} pixels to {}'.format(len(vec), cacheFile)
+    nPairs = 0
+    tempName = cacheFile+'.tmp'
+    try:
+        tempFile = open(tempName, 'wb')
+        pool = None
+        try:
+            if workers > 1:
+                pool = Pool(workers, initializer=initWorker,
+                            initargs=(vec, None, None, binParams, useTree))
+                pairList = pool.imap(getWorkerPairs, blocks)
+            else:
+                tree = cKDTree(vec) if useTree else None
+                pairList = (getPairs(vec, binParams, block, tree) for block in blocks)
+            for iIdx, jIdx, binIdx in pairList:
+                records = np.empty(len(iIdx), dtype=pairDtype)
+                records['i'], records['j'], records['bin'] = iIdx, jIdx, binIdx
+                records.tofile(tempFile)
+                nPairs += len(records)
+        finally:
+            tempFile.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+        os.rename(tempName, cacheFile)
+    finally:
+        # Never leave a partial cache behind
+        if os.path.exists(tempName):
+            os.remove(tempName)
+    print 'INFO: Cached {} pixel pairs.'.format(nPairs)
+    return nPairs
+
+def loadPairCache(cacheFile, nPixels, nBins):
+    """
+    Returns a read-only memory map of the pairs stored in cacheFile.
+    nPixels and nBins must match the values used to build the cache.
+    """
+    pairDtype = getPairDtype(nPixels, nBins)
+    if os.path.getsize(cacheFile) == 0:
+        return np.zeros(0, dtype=pairDtype)
+    return np.memmap(cacheFile, dtype=pairDtype, mode='r')
+
+def computeStructureFunctionCached(pairs, rm, erm, nBins, chunkSize=10**7):
+    """
+    Computes (sumRM, sumVar, count) from cached pairs. rm and erm are
+    the values of the cached pixels, in cache order, with nan for all
+    pixels that must be excluded. Only the RM differences are computed
+    for each pair.
+    """
+    rm  = np.asarray(rm, dtype=np.float64)
+    var = np.square(np.asarray(erm, dtype=np.float64))
+    var[~np.isfinite(rm)] = np.nan
+    hist = newHistogram(nBins)
+    for start in range(0, len(pairs), chunkSize):
+        chunk  = pairs[start:start+chunkSize]
+        iIdx, jIdx = chunk['i'], chunk['j']
+        rmSqDiff = np.square(rm[iIdx] - rm[jIdx])
+        varSum   = var[iIdx] + var[jIdx]
+        keep = np.isfinite(rmSqDiff) & np.isfinite(varSum)
+        binIdx = chunk['bin'][keep].astype(np.int64)
+        addHistogram(hist, [np.bincount(binIdx, weights=rmSqDiff[keep], minlength=nBins),
+                            np.bincount(binIdx, weights=varSum[keep], minlength=nBins),
+                            np.bincount(binIdx, minlength=nBins)])
+    print 'INFO: {} valid values were used for binning.'.format(hist[2].sum())
+    return hist
+
+def getStructureFunction(sumRM, sumVar, count):
+    """
+    Computes the averages in each bin. Empty bins are set to nan.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rmVal  = np.where(count > 0, sumRM/count, np.nan)
+        eRMVal = np.where(count > 0, sumVar/count, np.nan)
+    return rmVal, eRMVal
+
+def getLagDistances(shape, pixScale):
+    """
+    Returns the angular distance in deg corresponding to every lag of
+    an FFT grid with the given shape. pixScale is the (y, x) pixel size
+    in deg. The flat-sky approximation is used.
+    """
+    dy = np.fft.fftfreq(shape[0], 1./shape[0])*pixScale[0]
+    dx = np.fft.fftfreq(shape[1], 1./shape[1])*pixScale[1]
+    return np.hypot(dy[:,np.newaxis], dx[np.newaxis,:])
+
+def computeStructureFunctionFFT(fdArray, errArray, mask, pixScale,
+                                binStart, nBins, binSize):
+    """
+    Computes the binned structure function of a regularly gridded FD
+    map using masked autocorrelations computed with FFTs. Pixels that
+    are blanked in either map or flagged in the optional boolean mask
+    are excluded. Returns (sumRM, sumVar, count) like
+    computeStructureFunction.
+    """
+    valid = np.isfinite(fdArray) & np.isfinite(errArray)
+    if mask is not None:
+        valid &= ~mask
+    # Remove the mean RM to limit round-off in the cross term
+    fdVal = np.where(valid, fdArray - np.mean(fdArray[valid]), 0.)
+    varVal= np.where(valid, np.square(errArray), 0.)
+    # Zero-pad to twice the image size to avoid wrap-around
+    shape = (2*fdArray.shape[0], 2*fdArray.shape[1])
+    ftMask = np.fft.rfft2(valid.astype(np.float64), shape)
+    ftRM   = np.fft.rfft2(fdVal, shape)
+    ftRMSq = np.fft.rfft2(np.square(fdVal), shape)
+    ftVar  = np.fft.rfft2(varVal, shape)
+    # Sum over all pairs separated by each lag r
+    #   count(r)  = sum M(x)M(x+r)
+    #   sumRM(r)  = sum M(x)M(x+r)[RM(x) - RM(x+r)]^2
+    #   sumVar(r) = sum M(x)M(x+r)[var(x) + var(x+r)]
+    cross = np.conj(ftRMSq)*ftMask
+    lagRM = np.fft.irfft2(cross + np.conj(cross) - 2*np.square(np.absolute(ftRM)), shape)
+    cross = np.conj(ftVar)*ftMask
+    lagVar= np.fft.irfft2(cross + np.conj(cross), shape)
+    lagCount = np.fft.irfft2(np.square(np.absolute(ftMask)), shape)
+    del cross, ftMask, ftRM, ftRMSq, ftVar
+    # Bin the lags. Every pair is counted at both r and -r.
+    binIdx = getDistBinIndex(getLagDistances(shape, pixScale), binStart,
+                             nBins, binSize).ravel()
+    keep = binIdx >= 0
+    binIdx = binIdx[keep]
+    return [np.bincount(binIdx, weights=lagRM.ravel()[keep], minlength=nBins)/2.,
+            np.bincount(binIdx, weights=lagVar.ravel()[keep], minlength=nBins)/2.,
+            np.rint(np.bincount(binIdx, weights=lagCount.ravel()[keep],
+                                minlength=nBins)/2.).astype(np.int64)]
+
+def computeStructureFunctionMC(fdArray, errArray, mask, pixScale, binStart,
+                               nBins, binSize, relErr=0.05, maxPairs=10**8,
+                               batchSize=10**5, seed=None):
+    """
+    Estimates the binned structure function of a regularly gridded FD
+    map from randomly drawn pixel pairs. Pairs are drawn separately for
+    each bin by combining a random valid pixel with a random pixel lag
+    that falls within the bin, so every pair in a bin is equally likely.
+    Drawing stops once the relative standard error of every bin is below
+    relErr or maxPairs pairs have been drawn.
+    Returns (sumRM, sumVar, count, stdErr), where stdErr is the standard
+    error of the structure function in each bin.
+    """
+    valid = np.isfinite(fdArray) & np.isfinite(errArray)
+    if mask is not None:
+        valid &= ~mask
+    validY, validX = np.nonzero(valid)
+    ny, nx = fdArray.shape
+    rng = np.random.RandomState(seed)
+    sumRM  = np.zeros(nBins)
+    sumVar = np.zeros(nBins)
+    sumSF  = np.zeros(nBins)
+    sumSFSq= np.zeros(nBins)
+    count  = np.zeros(nBins, dtype=np.int64)
+    stdErr = np.zeros(nBins) + np.nan
+    # Largest pixel lag along each axis that can fall in each bin
+    maxDist = 10**(binStart + (np.arange(nBins)+0.5)*binSize)
+    maxLagY = np.minimum(np.floor(maxDist/pixScale[0]), ny-1).astype(np.int64)
+    maxLagX = np.minimum(np.floor(maxDist/pixScale[1]), nx-1).astype(np.int64)
+    # Bins that do not contain any pixel lag can never be populated
+    active = np.ones(nBins, dtype=bool)
+    for b in range(nBins):
+        if (2*maxLagY[b]+1)*(2*maxLagX[b]+1) <= 10**6:
+            lagY, lagX = np.mgrid[-maxLagY[b]:maxLagY[b]+1, -maxLagX[b]:maxLagX[b]+1]
+            lagBins = getDistBinIndex(np.hypot(lagY*pixScale[0], lagX*pixScale[1]),
+                                      binStart, nBins, binSize)
+            active[b] = (lagBins == b).any()
+    nDrawn = 0
+    while active.any() and nDrawn < maxPairs and len(validY) > 1:
+        for b in np.nonzero(active)[0]:
+            # Draw a random valid pixel and a random lag within this bin
+            anchor = rng.randint(0, len(validY), batchSize)
+            dy = rng.randint(-maxLagY[b], maxLagY[b]+1, batchSize)
+            dx = rng.randint(-maxLagX[b], maxLagX[b]+1, batchSize)
+            y1, x1 = validY[anchor], validX[anchor]
+            y2, x2 = y1 + dy, x1 + dx
+            keep = getDistBinIndex(np.hypot(dy*pixScale[0], dx*pixScale[1]),
+                                   binStart, nBins, binSize) == b
+            keep &= (y2 >= 0) & (y2 < ny) & (x2 >= 0) & (x2 < nx)
+            y1, x1, y2, x2 = y1[keep], x1[keep], y2[keep], x2[keep]
+            keep = valid[y2, x2]
+            y1, x1, y2, x2 = y1[keep], x1[keep], y2[keep], x2[keep]
+            rmSqDiff = np.square(fdArray[y1, x1] - fdArray[y2, x2])
+            varSum   = np.square(errArray[y1, x1]) + np.square(errArray[y2, x2])
+            sumRM[b]  += rmSqDiff.sum()
+            sumVar[b] += varSum.sum()
+            sumSF[b]  += (rmSqDiff - varSum).sum()
+            sumSFSq[b]+= np.square(rmSqDiff - varSum).sum()
+            count[b]  += len(rmSqDiff)
+            nDrawn    += batchSize
+        # Update the standard error and drop the bins that have converged
+        with np.errstate(divide='ignore', invalid='ignore'):
+            meanSF = sumSF/count
+            stdErr = np.sqrt((sumSFSq/count - np.square(meanSF))/(count-1))
+            active &= ~((count > 1) & (stdErr <= relErr*np.absolute(meanSF)))
+    print 'INFO: Drew {} random pixel pairs.'.format(nDrawn)
+    if active.any():
+        print 'INFO: {} bins did not reach the requested relative error.'.\
+              format(active.sum())
+    return sumRM, sumVar, count, stdErr
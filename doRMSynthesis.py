@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+"""
+doRMSynthesis.py
+
+Performs RM synthesis on Stokes Q and U cubes and writes the amplitude of
+the Faraday dispersion function, the peak Faraday depth map and the peak
+polarized intensity map. Optionally, the Faraday spectra are deconvolved
+with RM-CLEAN first.
+
+The cubes are memory-mapped and processed in blocks of image rows that
+fit in a memory budget per worker.
+"""
+import optparse
+import os
+from multiprocessing import Pool
+try:
+    import numpy as np
+except ImportError:
+    raise Exception('Unable to import Numpy.')
+try:
+    import pyfits as pf
+except ImportError:
+    raise Exception('Unable to import pyFits.')
+from rmsfCache import getCachedRMSF, getCachedKernel
+from rmUtils import readColumn, getKernel, getRMSFWidth
+c = 299792458. # [m/s]
+
+def getCubeData(name):
+    """
+    Returns a memory-mapped cube from a fits file as (nchan, y, x).
+    """
+    data = pf.open(name, memmap=True)[0].data
+    return data.reshape(data.shape[-3:])
+
+def synthesizeBlock(qData, uData, kernel, weights):
+    """
+    Computes the Faraday dispersion function of a block of (nchan, ...)
+    spectra as one matrix product. Blanked channels get zero weight and
+    each spectrum is normalized by the sum of its own weights. Returns
+    F(phi) and the (nchan, nPix) mask of the channels that are not blanked.
+    """
+    shape = qData.shape[1:]
+    pol = np.asarray(qData, dtype=np.float64).reshape(qData.shape[0], -1) + \
+          1j*np.asarray(uData, dtype=np.float64).reshape(uData.shape[0], -1)
+    valid = np.isfinite(pol)
+    pol[~valid] = 0.
+    pixWeights = weights[:, np.newaxis]*valid
+    norm = pixWeights.sum(axis=0)
+    fdf = kernel.dot(pol*pixWeights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fdf /= norm
+    fdf[:, norm == 0] = np.nan
+    return fdf.reshape((kernel.shape[0],)+shape), valid
+
+def getPeak(absFDF, phiArray):
+    """
+    Returns the Faraday depth and amplitude of the peak of |F| along the
+    first axis. The peak is refined with a parabola through the three
+    samples around the maximum.
+    """
+    shape = absFDF.shape[1:]
+    filled = np.where(np.isfinite(absFDF), absFDF, -np.inf).reshape(len(phiArray), -1)
+    index = np.argmax(filled, axis=0)
+    pixels = np.arange(filled.shape[1])
+    inner = np.clip(index, 1, len(phiArray)-2)
+    y0 = filled[inner-1, pixels]
+    y1 = filled[inner, pixels]
+    y2 = filled[inner+1, pixels]
+    with np.errstate(invalid='ignore'):
+        denom = y0 - 2*y1 + y2
+        refine = (index == inner) & (denom < 0)
+        shift = np.where(refine, 0.5*(y0 - y2)/np.where(refine, denom, 1.), 0.)
+    peakFD = phiArray[index] + shift*(phiArray[1] - phiArray[0])
+    peakPI = filled[index, pixels] - 0.25*(y0 - y2)*shift
+    blank = ~np.isfinite(filled[index, pixels])
+    peakFD[blank] = np.nan
+    peakPI[blank] = np.nan
+    return peakFD.reshape(shape), peakPI.reshape(shape)
+
+def getRMSFKernel(lam2, weights, delPhi, nPhi, lam2_0):
+    """
+    Returns the RMSF sampled at delPhi*k for k = -(nPhi-1) ... nPhi-1, with
+    the same lambda_0^2 convention as getRMSF.py.
+    """
+    shifts = delPhi*np.arange(-(nPhi-1), nPhi)
+    return getKernel(lam2, shifts, lam2_0).dot(weights)/weights.sum()
+
+def getRestoringBeam(delPhi, nPhi, fwhm):
+    """
+    Returns a Gaussian restoring beam with the given FWHM, sampled like
+    the RMSF kernel.
+    """
+    shifts = delPhi*np.arange(-(nPhi-1), nPhi)
+    return np.exp(-4*np.log(2)*np.square(shifts/fwhm))
+
+def restoreComponents(components, beam):
+    """
+    Convolves the clean components (nPhi, nPix) along Faraday depth with
+    the restoring beam sampled like the RMSF kernel.
+    """
+    nPhi = components.shape[0]
+    nFFT = 2*len(beam)
+    conv = np.fft.ifft(np.fft.fft(components, nFFT, axis=0) * \
+                       np.fft.fft(beam, nFFT)[:, np.newaxis], axis=0)
+    return conv[nPhi-1:2*nPhi-1]
+
+def getFDFNoise(fdf):
+    """
+    Returns a robust estimate of the noise in the real and imaginary parts
+    of dirty Faraday spectra (nPhi, nPix), from the median absolute
+    deviation along Faraday depth. The Faraday depth grid should be wide
+    compared to the RMSF.
+    """
+    deviation = np.concatenate([np.absolute(part - np.median(part, axis=0)) \
+                                for part in [fdf.real, fdf.imag]])
+    return 1.4826*np.median(deviation, axis=0)
+
+def rmCleanBlock(fdf, rmsf, beam, gain=0.1, cutoff=None, nSigma=5., maxIter=1000):
+    """
+    Runs RM-CLEAN on a block of dirty Faraday spectra (nPhi, nPix) at once.
+    Each iteration subtracts gain times the RMSF shifted to the peak of
+    every unconverged spectrum. A spectrum drops out once the peak of its
+    residual falls below cutoff or, if no cutoff is given, below nSigma
+    times the noise of its dirty spectrum. Returns the restored spectra.
+    """
+    nPhi = fdf.shape[0]
+    blank = ~np.isfinite(fdf).all(axis=0)
+    residual = np.where(np.isfinite(fdf), fdf, 0.)
+    if cutoff is None:
+        threshold = nSigma*getFDFNoise(residual)
+    else:
+        threshold = np.repeat(float(cutoff), fdf.shape[1])
+    components = np.zeros_like(residual)
+    shifts = np.arange(nPhi)[:, np.newaxis] + (nPhi-1)
+    active = np.arange(fdf.shape[1])
+    for i in range(maxIter):
+        absRes = np.absolute(residual[:, active])
+        peak = np.argmax(absRes, axis=0)
+        keep = absRes[peak, np.arange(len(active))] > threshold[active]
+        active, peak = active[keep], peak[keep]
+        if len(active) == 0:
+            break
+        amp = gain*residual[peak, active]
+        components[peak, active] += amp
+        residual[:, active] -= amp*rmsf[shifts - peak]
+    clean = restoreComponents(components, beam) + residual
+    clean[:, blank] = np.nan
+    return clean
+
+def cleanBlock(fdf, valid, lam2, weights, delPhi, lam2_0, rmsf, beam, *loopParams):
+    """
+    Runs RM-CLEAN on a block of dirty Faraday spectra (nPhi, nPix). The
+    spectra with blanked channels have a different RMSF, so they are
+    cleaned and restored with the RMSF and beam of their own weights, one
+    per distinct set of blanked channels.
+    """
+    nPhi = fdf.shape[0]
+    clean = np.empty_like(fdf)
+    full = valid.all(axis=0)
+    if full.any():
+        clean[:, full] = rmCleanBlock(fdf[:, full], rmsf, beam, *loopParams)
+    partial = np.flatnonzero(~full)
+    if len(partial) > 0:
+        patterns, inverse = np.unique(valid[:, partial].T, axis=0, return_inverse=True)
+        for k, pattern in enumerate(patterns):
+            pixels = partial[inverse == k]
+            pixWeights = weights*pattern
+            if pixWeights.sum() == 0:
+                clean[:, pixels] = np.nan
+                continue
+            pixFWHM = getRMSFWidth(lam2, pixWeights, lam2_0)
+            if not np.isfinite(pixFWHM):
+                # A single channel does not resolve anything in Faraday depth
+                clean[:, pixels] = fdf[:, pixels]
+                continue
+            pixRMSF = getRMSFKernel(lam2, pixWeights, delPhi, nPhi, lam2_0)
+            pixBeam = getRestoringBeam(delPhi, nPhi, pixFWHM)
+            clean[:, pixels] = rmCleanBlock(fdf[:, pixels], pixRMSF, pixBeam, *loopParams)
+    return clean
+
+workerData = {}
+
+def getCleanParams(lam2, weights, phiArray, lam2_0, gain, cutoff, nSigma, maxIter,
+                   cacheDir='', cacheSize=2048, keep=()):
+    """
+    Returns the RMSF, the restoring beam and the loop settings for
+    rmCleanBlock. The RMSF is taken from the cache if cacheDir is given.
+    The cache entries in keep are not evicted.
+    """
+    delPhi = phiArray[1] - phiArray[0]
+    shifts = delPhi*np.arange(-(len(phiArray)-1), len(phiArray))
+    rmsfFunc = lambda: getRMSFKernel(lam2, weights, delPhi, len(phiArray), lam2_0)
+    if cacheDir != '':
+        rmsf, fwhm, maxScale = getCachedRMSF(cacheDir, lam2, weights, shifts, lam2_0,
+                                             rmsfFunc, cacheSize, keep)
+    else:
+        rmsf = rmsfFunc()
+        fwhm = getRMSFWidth(lam2, weights, lam2_0)
+    beam = getRestoringBeam(delPhi, len(phiArray), fwhm)
+    return rmsf, beam, gain, cutoff, nSigma, maxIter
+
+def initWorker(qFile, uFile, lam2, weights, phiArray, lam2_0, cleanParams=None,
+               kernelFile=''):
+    """
+    Opens the memory-mapped cubes and the kernel in each worker process of
+    the pool. The kernel is built here unless a cached kernel file is given.
+    """
+    workerData['cubes'] = (getCubeData(qFile), getCubeData(uFile))
+    if kernelFile != '':
+        workerData['kernel'] = np.load(kernelFile, mmap_mode='r')
+    else:
+        workerData['kernel'] = getKernel(lam2, phiArray, lam2_0)
+    workerData['weights'] = weights
+    workerData['phi'] = phiArray
+    workerData['lam2'] = (lam2, lam2_0)
+    workerData['clean'] = cleanParams
+
+def synthesizeWorkerBlock(block):
+    """
+    RM synthesis of the image rows start:stop.
+    """
+    start, stop = block
+    qData, uData = workerData['cubes']
+    fdf, valid = synthesizeBlock(qData[:, start:stop], uData[:, start:stop],
+                                 workerData['kernel'], workerData['weights'])
+    if workerData['clean'] is not None:
+        shape = fdf.shape
+        lam2, lam2_0 = workerData['lam2']
+        phiArray = workerData['phi']
+        fdf = cleanBlock(fdf.reshape(shape[0], -1), valid, lam2, workerData['weights'],
+                         phiArray[1]-phiArray[0], lam2_0, *workerData['clean']).reshape(shape)
+    absFDF = np.absolute(fdf)
+    peakFD, peakPI = getPeak(absFDF, workerData['phi'])
+    return start, absFDF.astype(np.float32), peakFD, peakPI
+
+def openFitsMemmap(name, header):
+    """
+    Writes the header of a float32 fits file and returns a writable memory
+    map of its data section.
+    """
+    shape = tuple(header['NAXIS{}'.format(i)] for i in range(header['NAXIS'], 0, -1))
+    dataSize = 4*int(np.prod(shape))
+    f = open(name, 'wb')
+    f.write(header.tostring())
+    offset = f.tell()
+    f.truncate(offset + dataSize + (2880 - dataSize%2880)%2880)
+    f.close()
+    return np.memmap(name, dtype='>f4', mode='r+', offset=offset, shape=shape)
+
+def getFDFHeader(header, phiArray):
+    """
+    Returns the header of the |F| cube, with the frequency axis replaced
+    by Faraday depth.
+    """
+    header = header.copy()
+    header['BITPIX'] = -32
+    for key in ['BSCALE', 'BZERO', 'BLANK']:
+        if key in header:
+            del header[key]
+    header['NAXIS3'] = len(phiArray)
+    header['CTYPE3'] = 'FDEP'
+    header['CRPIX3'] = 1.
+    header['CRVAL3'] = phiArray[0]
+    header['CDELT3'] = phiArray[1]-phiArray[0] if len(phiArray) > 1 else 1.
+    header['CUNIT3'] = 'rad/m^2'
+    return header
+
+def writeMap(name, data, header, unit):
+    """
+    Writes a (1, y, x) map with the header of the input cube.
+    """
+    header = header.copy()
+    header['BUNIT'] = unit
+    hdu = pf.PrimaryHDU(data=data[np.newaxis].astype(np.float32), header=header)
+    hdu.writeto(name, clobber=True)
+    del hdu
+
+def getBlockSize(shape, nPhi, maxMemory, clean=False):
+    """
+    Returns the number of image rows of a (nchan, y, x) cube that a
+    worker can process within about maxMemory MB. Per pixel, a block
+    holds the complex spectrum with its weights and the complex F(phi)
+    with its amplitude; RM-CLEAN adds the residual, the components and
+    the padded FFTs of the restoring step.
+    """
+    pixelSize = 48*shape[0] + 32*nPhi
+    if clean:
+        pixelSize += 96*nPhi
+    return int(min(shape[1], max(1, maxMemory*1024.**2//(pixelSize*shape[2]))))
+
+def runRMSynthesis(qFile, uFile, freqList, weights, phiArray, outName,
+                   maxMemory=256., workers=1, cleanParams=None, cacheDir='',
+                   cacheSize=2048):
+    """
+    Runs RM synthesis over the memory-mapped Q and U cubes in blocks of
+    rows that fit in about maxMemory MB per worker. If cleanParams
+    (gain, cutoff, nSigma, maxIter) are given, the spectra are
+    deconvolved with RM-CLEAN. The |F| blocks are written
+    straight into the output cube. If cacheDir is given, the kernel and
+    the RMSF are read from or stored in the cache there.
+    Returns the peak Faraday depth and peak polarized intensity maps.
+    """
+    lam2 = (c/np.asarray(freqList))**2
+    lam2_0 = np.median(lam2)
+    kernelFile = ''
+    if cacheDir != '':
+        kernelFile = getCachedKernel(cacheDir, lam2, phiArray, lam2_0, cacheSize)
+    if cleanParams is not None:
+        # The RMSF entry must not evict the kernel this run is using
+        cleanParams = getCleanParams(lam2, weights, phiArray, lam2_0, *cleanParams,
+                                     cacheDir=cacheDir, cacheSize=cacheSize,
+                                     keep=[kernelFile])
+    qData = getCubeData(qFile)
+    shape = qData.shape
+    header = pf.getheader(qFile)
+    fdfCube = openFitsMemmap(outName, getFDFHeader(header, phiArray))
+    fdfView = fdfCube.reshape((len(phiArray),)+shape[1:])
+    peakFD = np.zeros(shape[1:])
+    peakPI = np.zeros(shape[1:])
+    blockSize = getBlockSize(shape, len(phiArray), maxMemory, cleanParams is not None)
+    print 'INFO: Processing {} rows at a time'.format(blockSize)
+    blocks = [(start, min(start+blockSize, shape[1])) for start in range(0, shape[1], blockSize)]
+    initargs = (qFile, uFile, lam2, weights, phiArray, lam2_0, cleanParams, kernelFile)
+    if workers > 1:
+        pool = Pool(workers, initializer=initWorker, initargs=initargs)
+        results = pool.imap_unordered(synthesizeWorkerBlock, blocks)
+    else:
+        initWorker(*initargs)
+        results = (synthesizeWorkerBlock(block) for block in blocks)
+    try:
+        for start, absFDF, blockFD, blockPI in results:
+            stop = start + absFDF.shape[1]
+            fdfView[:, start:stop] = absFDF
+            peakFD[start:stop] = blockFD
+            peakPI[start:stop] = blockPI
+    finally:
+        if workers > 1:
+            pool.close()
+            pool.join()
+    fdfCube.flush()
+    del fdfView, fdfCube
+    return peakFD, peakPI, header
+
+def main(options):
+    # Check user input
+    if options.qFile == '' or options.uFile == '':
+        raise Exception('Input Q and U cubes must be specified.')
+    if options.freq == '':
+        raise Exception('A file containing frequency list must be specified.')
+    minPhi = float(options.minphi)
+    delPhi = float(options.delphi)
+    nPhi   = int(options.nphi)
+    if nPhi < 3:
+        raise Exception('At least 3 Faraday depths are needed.')
+
+    # Read the frequencies and the weights
+    freqList = readColumn(options.freq)
+    if options.weights != '':
+        weights = readColumn(options.weights)
+        if len(weights) != len(freqList):
+            raise Exception('Number of weights does not match the number of frequencies.')
+    else:
+        weights = np.ones(len(freqList))
+    qShape = getCubeData(options.qFile).shape
+    uShape = getCubeData(options.uFile).shape
+    print 'INFO: Stokes Q: {}, Stokes U: {}'.format(qShape, uShape)
+    if qShape != uShape:
+        raise Exception('Stokes Q and U cubes have different dimensions.')
+    if qShape[0] != len(freqList):
+        raise Exception('No. of frequency channels in input files do not match.')
+
+    # Run RM synthesis
+    cleanParams = None
+    suffixes = ['_FDF.fits', '_peakFD.fits', '_peakPI.fits']
+    if options.clean:
+        cutoff = None if options.cutoff == '' else float(options.cutoff)
+        cleanParams = (float(options.gain), cutoff, float(options.nSigma), int(options.maxIter))
+        suffixes = ['_cleanFDF.fits', '_cleanPeakFD.fits', '_cleanPeakPI.fits']
+    outName = options.out+suffixes[0]
+    if os.path.exists(outName):
+        raise Exception('Output file {} already exists.'.format(outName))
+    phiArray = minPhi + delPhi*np.arange(nPhi)
+    print 'INFO: Computing F(phi) at {} Faraday depths for {}x{} pixels using {} workers'.\
+          format(nPhi, qShape[1], qShape[2], options.workers)
+    peakFD, peakPI, header = runRMSynthesis(options.qFile, options.uFile, freqList,
+                                            weights, phiArray, outName,
+                                            float(options.blockMemory), int(options.workers),
+                                            cleanParams, options.cacheDir,
+                                            float(options.cacheSize))
+    print 'INFO: Wrote |F| to {}'.format(outName)
+    writeMap(options.out+suffixes[1], peakFD, header, 'rad/m^2')
+    writeMap(options.out+suffixes[2], peakPI, header, header.get('BUNIT', ''))
+    print 'INFO: Wrote the peak Faraday depth and polarized intensity maps'
+
+if __name__ == '__main__':
+    opt = optparse.OptionParser()
+    opt.add_option('-q', '--qFile', help='Stokes Q cube [no default]', default='')
+    opt.add_option('-u', '--uFile', help='Stokes U cube [no default]', default='')
+    opt.add_option('-f', '--freq', help='Text file containing the frequency '+
+                   'list [no default]', default='')
+    opt.add_option('-w', '--weights', help='Text file containing one weight per '+
+                   'frequency [default: uniform weights]', default='')
+    opt.add_option('-m', '--minphi', help='Minimum Faraday depth [default: -50 rad/m2]',
+                   default='-50')
+    opt.add_option('-d', '--delphi', help='Delta Faraday depth [default: 1 rad/m2]',
+                   default='1')
+    opt.add_option('-n', '--nphi', help='Number of Faraday depths [default: 100]',
+                   default='100')
+    opt.add_option('-o', '--out', help='Prefix of the output files [default: rmsynth]',
+                   default='rmsynth')
+    opt.add_option('-b', '--blockMemory', help='Memory in MB used by each worker. The '+
+                   'cubes are processed in blocks of rows that fit in it [default: 256]',
+                   default='256')
+    opt.add_option('-j', '--workers', help='Number of worker processes [default: 1]',
+                   default='1')
+    opt.add_option('-c', '--clean', action='store_true', help='Deconvolve the Faraday '+
+                   'spectra with RM-CLEAN [default: False]', default=False)
+    opt.add_option('-g', '--gain', help='RM-CLEAN loop gain [default: 0.1]', default='0.1')
+    opt.add_option('-t', '--cutoff', help='RM-CLEAN stops for a pixel once its residual '+
+                   'peak is below this polarized intensity [default: use --nSigma]',
+                   default='')
+    opt.add_option('-s', '--nSigma', help='Without --cutoff, RM-CLEAN stops for a pixel '+
+                   'once its residual peak is below nSigma times the noise of its dirty '+
+                   'Faraday spectrum, estimated from the median absolute deviation of the '+
+                   'real and imaginary parts along Faraday depth [default: 5]', default='5')
+    opt.add_option('-i', '--maxIter', help='Maximum number of RM-CLEAN iterations '+
+                   '[default: 1000]', default='1000')
+    opt.add_option('--cacheDir', help='Directory to cache the RM synthesis kernel and '+
+                   'the RMSF in [default: none]', default='')
+    opt.add_option('--cacheSize', help='Maximum size of the cache in MB [default: 2048]',
+                   default='2048')
+    options, arguments = opt.parse_args()
+    main(options)
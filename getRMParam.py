@@ -2,15 +2,23 @@
 import optparse
 from numpy import sqrt
 
-def main(options):
-   lightspeed = 299792458.
-   chanWidth = float( options.chan ) * 1.E6
-   centFreq  = float( options.freq ) * 1.E9
-   
+lightspeed = 299792458.
+
+def getMaxPhi(centFreq, chanWidth):
+   """
+   Returns the maximum Faraday depth for channels of width chanWidth [Hz]
+   at centFreq [Hz]. Works on scalars and arrays.
+   """
    part1 = (2 * lightspeed**2 * chanWidth)/(centFreq**3)
    part2 = 1. + (0.5*(chanWidth/centFreq)**2)
    delLam2 = part1 * part2
-   maxPhi = sqrt(3) / delLam2
+   return sqrt(3) / delLam2
+
+def main(options):
+   chanWidth = float( options.chan ) * 1.E6
+   centFreq  = float( options.freq ) * 1.E9
+
+   maxPhi = getMaxPhi(centFreq, chanWidth)
    print 'Max Faraday depth is', maxPhi
 
 if __name__ == '__main__':
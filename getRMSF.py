@@ -6,13 +6,13 @@ This script plots the Rotation Measure Spread Function for a given
 list of frequencies.
 
 Written by Sarrvesh S. Sridhar
-
-To do:
-* Include weights
 """
 import sys
+import os
 import optparse
+from math import factorial
 try:
+    import numpy as np
     from numpy import median, zeros, exp, absolute, amin, amax, sqrt, pi
 except ImportError:
     raise Exception('Unable to import Numpy.')
@@ -20,57 +20,127 @@ try:
     import matplotlib.pyplot as plt
 except ImportError:
     raise Exception('Unable to import Matplotlib.')
+from rmsfCache import getCachedRMSF
+from rmUtils import readColumn, getKernel, getRMSFWidth
 c = 299792458. # [m/s]
 
+def getRMSF(lam2, weights, phiArray, lam2_0, chunkSize=None):
+    """
+    Computes R(phi) = sum_j w_j exp(-2i phi (lam2_j - lam2_0)) / sum_j w_j
+    as a matrix product, in chunks of chunkSize Faraday depths so the
+    (nPhi, nChan) kernel stays bounded in memory.
+    """
+    lam2 = np.asarray(lam2, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    phiArray = np.asarray(phiArray, dtype=np.float64)
+    if chunkSize is None:
+        chunkSize = max(1, 4000000//len(lam2))
+    rmsf = np.empty(len(phiArray), dtype=np.complex128)
+    for start in range(0, len(phiArray), chunkSize):
+        phi = phiArray[start:start+chunkSize]
+        rmsf[start:start+chunkSize] = getKernel(lam2, phi, lam2_0).dot(weights)
+    return rmsf/weights.sum()
+
+def getRMSFNUFFT(lam2, weights, minPhi, delPhi, nPhi, lam2_0, eps=1.E-9):
+    """
+    Computes the RMSF on the regular grid minPhi + k*delPhi, k < nPhi,
+    with a non-uniform FFT. Each phase t = 2 delPhi (lam2 - lam2_0) is
+    moved to the nearest point of a grid twice as fine as the output, and
+    the phase error of that shift is corrected with a Taylor series, one
+    FFT per term, until the terms fall below eps.
+    """
+    x = np.asarray(lam2, dtype=np.float64) - lam2_0
+    weights = np.asarray(weights, dtype=np.float64)
+    # exp(-2i (minPhi + k delPhi) x) = exp(-2i minPhi x) exp(-i k t) with
+    # t = 2 delPhi x. Centering k on nPhi//2 halves the largest shift error.
+    center = nPhi//2
+    nGrid = 2*nPhi
+    t = 2*delPhi*x
+    grid = np.round(t*nGrid/(2*pi))
+    shift = t - 2*pi*grid/nGrid
+    cells = np.mod(grid, nGrid).astype(int)
+    strengths = weights*np.exp(-2j*minPhi*x)*np.exp(-1j*center*t)
+    modes = np.arange(nPhi) - center
+    rmsf = np.zeros(nPhi, dtype=np.complex128)
+    term = np.ones(nPhi, dtype=np.complex128)
+    bound = np.absolute(strengths).sum()
+    maxPhase = np.amax(np.absolute(modes))*np.amax(np.absolute(shift))
+    p = 0
+    while True:
+        gridded = np.bincount(cells, strengths.real, nGrid) + \
+                  1j*np.bincount(cells, strengths.imag, nGrid)
+        rmsf += term*np.fft.fft(gridded)[modes]
+        p += 1
+        term *= -1j*modes/p
+        strengths = strengths*shift
+        if bound*maxPhase**p/factorial(p) < eps*weights.sum():
+            break
+    return rmsf/weights.sum()
+
+def writeRMSF(fileName, phiArray, rmsf, lam2_0, fwhm):
+    """
+    Writes the RMSF as a .npz archive or, for any other extension,
+    as a CSV table.
+    """
+    if os.path.splitext(fileName)[1] == '.npz':
+        np.savez(fileName, phi=phiArray, real=rmsf.real, imag=rmsf.imag,
+                 abs=absolute(rmsf), lam2_0=lam2_0, fwhm=fwhm)
+    else:
+        np.savetxt(fileName, np.column_stack((phiArray, rmsf.real, rmsf.imag, absolute(rmsf))),
+                   delimiter=',', header='phi,real,imag,abs')
+
 def main(options):
     # Get the user input
     freqFile = options.freq
     minPhi   = float(options.minphi)
     delPhi   = float(options.delphi)
     nPhi     = int(options.nphi)
-    
+
     # Read the list of frequencies
-    lam2 = []
-    with open(freqFile) as f:
-        for line in f:
-    	    lam2.append( (c/float(line))**2 )
-    
+    lam2 = (c/readColumn(freqFile))**2
+    if options.weights != '':
+        weights = readColumn(options.weights)
+        if len(weights) != len(lam2):
+            raise Exception('Number of weights does not match the number of frequencies.')
+    else:
+        weights = np.ones(len(lam2))
+
     # Compute \lambda_0^2
     lam2_0 = median(lam2)
-    
-    # Get the normalization factor K
-    K = 0
-    for i in lam2:
-        K += 1
-    
-    # Compute the numerator of R(\phi)
-    maxPhi		= minPhi + delPhi*(nPhi-1)
-    absR  		= []
-    realR 		= []
-    imagR 		= []
-    phiArray 	= []
-    phi     	= minPhi
-    while phi < maxPhi:
-	    phiArray.append(phi)
-	    tempR = 0 + 0j
-	    for i in range(len(lam2)):
-	    	tempR += exp(-2*1j*phi*(lam2[i]-lam2_0))
-	    absR.append( absolute(tempR)/K )
-	    realR.append( tempR.real/K )
-	    imagR.append( tempR.imag/K )
-	    phi += delPhi
-    
+
+    # Compute R(\phi) normalized by the sum of the weights
+    phiArray = minPhi + delPhi*np.arange(nPhi)
+    if options.nufft:
+        method = 'nufft'
+        rmsfFunc = lambda: getRMSFNUFFT(lam2, weights, minPhi, delPhi, nPhi, lam2_0)
+    else:
+        method = 'direct'
+        rmsfFunc = lambda: getRMSF(lam2, weights, phiArray, lam2_0)
+    if options.cacheDir != '':
+        rmsf, fwhm, maxSize = getCachedRMSF(options.cacheDir, lam2, weights, phiArray,
+                                            lam2_0, rmsfFunc, float(options.cacheSize),
+                                            method=method)
+    else:
+        rmsf    = rmsfFunc()
+        fwhm    = getRMSFWidth(lam2, weights, lam2_0)
+        maxSize = pi/amin(lam2)
+
     # Print stats
-    fwhm 	= 3.8 / (amax(lam2)-amin(lam2)) # from Schnitzeler et al (2008)
-    maxSize = pi/amin(lam2)
-    print '\nFor a top-hat weight function:\n'
+    if options.weights != '':
+        print '\nFor the supplied weights:\n'
+    else:
+        print '\nFor a top-hat weight function:\n'
     print '\tFWHM: '+str(fwhm)+' rad/m2'
     print '\tMax scale: '+str(maxSize)+' rad/m2 \n'
-    
+
+    # Write the RMSF table
+    if options.out != '':
+        writeRMSF(options.out, phiArray, rmsf, lam2_0, fwhm)
+
     # Make plots
-    plt.plot(phiArray,absR,'black',label='|R|')
-    plt.plot(phiArray,realR,'r--',label='real(R)')
-    plt.plot(phiArray,imagR,'b--',label='imag(R)')
+    plt.plot(phiArray,absolute(rmsf),'black',label='|R|')
+    plt.plot(phiArray,rmsf.real,'r--',label='real(R)')
+    plt.plot(phiArray,rmsf.imag,'b--',label='imag(R)')
     plt.xlabel('Faraday depth [rad/m^2]')
     plt.ylabel('RMSF')
     plt.legend()
@@ -86,5 +156,15 @@ if __name__ == '__main__':
              default='1')
     opt.add_option('-n', '--nphi', help='Number of values to compute [default: 100]',
              default='100')
+    opt.add_option('-w', '--weights', help='Text file containing one weight per '+
+            'frequency [default: uniform weights]', default='')
+    opt.add_option('-o', '--out', help='Output table of the RMSF, .npz or CSV '+
+            '[default: none]', default='')
+    opt.add_option('-u', '--nufft', action='store_true', help='Compute the RMSF with '+
+            'a non-uniform FFT [default: False]', default=False)
+    opt.add_option('-c', '--cacheDir', help='Directory to cache the RMSF in '+
+            '[default: none]', default='')
+    opt.add_option('-s', '--cacheSize', help='Maximum size of the cache in MB '+
+            '[default: 2048]', default='2048')
     inOpts, arguments = opt.parse_args()
     main(inOpts)
@@ -12,6 +12,15 @@ To do list:
 import optparse
 import glob
 import os
+import time
+import threading
+import Queue
+import re
+import shutil
+import tempfile
+import zlib
+from functools import partial
+from multiprocessing.pool import ThreadPool
 try:
     import numpy as np
 except ImportError:
@@ -21,99 +30,752 @@ try:
 except ImportError:
     raise Exception('Unable to import pyFits.')
 
+STOKES_CODES = {'I': 1, 'Q': 2, 'U': 3, 'V': 4}
+COMPRESSION_TYPES = ['GZIP_1', 'GZIP_2']
+ZBLANK = -2147483648
+
 version_string = 'v1.0, 8 June 2015\nWritten by Sarrvesh S. Sridhar'
 print 'makeFitsCube.py', version_string
 print ''
 
-def getValidFitsList(fileList):
+def isFitsFile(name):
+    """
+    Checks if a file is a fits file using its magic number.
+    """
+    try:
+        with open(name, 'rb') as f:
+            return f.read(9) == 'SIMPLE  ='
+    except IOError:
+        return False
+
+def scanFitsHeader(name, FLAG):
+    """
+    Reads the shape and frequency of a fits file from its header without
+    reading the data. The shape excludes the outermost axis, as in
+    data[0].shape. Returns None if the file is not a fits file.
+    """
+    if not isFitsFile(name):
+        return None
+    header = pf.getheader(name, 0)
+    shape = tuple(header['NAXIS{}'.format(i)] for i in range(header['NAXIS']-1, 0, -1))
+    return name, shape, header[FLAG], header
+
+def getChannelIndex(fileList, FLAG, nThreads):
     """
-    Extracts fits files from a list of files using its magic number.
+    Scans the headers of a list of files using a pool of threads.
+    Return a list of (name, shape, frequency, header) for all fits files.
     """
-    validFitsList = []
-    for name in fileList:
-        if 'FITS' in os.popen('file {}'.format(name)).read():
-            validFitsList.append(name)
-    return validFitsList
+    if len(fileList) == 0:
+        return []
+    # Scan the first file before starting the threads so that pyFits
+    # completes its lazy imports in the main thread
+    channelIndex = [scanFitsHeader(fileList[0], FLAG)]
+    pool = ThreadPool(nThreads)
+    try:
+        channelIndex += pool.map(lambda name: scanFitsHeader(name, FLAG), fileList[1:])
+    finally:
+        pool.close()
+        pool.join()
+    return [entry for entry in channelIndex if entry is not None]
 
-def checkFitsShape(fitsList):
+def checkFitsShape(channelIndex):
     """
     Checks if the list of fits files all have the same shape.
-    If True, return the shape and memory in bytes of a single fits file
+    If True, return the shape of a single fits file
     If False, raises an exception causing the execution to terminate
     """
-    for i, name in enumerate(fitsList):
-        if i == 0:
-            templateShape = pf.open(name, readonly=True)[0].data[0].shape
-        elif templateShape != pf.open(name, readonly=True)[0].data[0].shape:
+    templateShape = channelIndex[0][1]
+    for name, shape, freq, header in channelIndex:
+        if shape != templateShape:
             raise Exception('Fits file {} has an incompatible shape'.format(name))
     return templateShape
 
-def concatenateWithMemMap(validFitsList, shape, memMapName, FLAG):
+def getChannelSpacing(freqList):
+    """
+    Returns the spacing of a list of channel frequencies, or None if the
+    channels are not evenly spaced. A single channel has no spacing.
+    """
+    steps = np.diff(freqList)
+    if len(steps) == 0 or steps[0] == 0 or \
+       not np.allclose(steps, steps[0], rtol=1.E-6, atol=0.):
+        return None
+    return (freqList[-1]-freqList[0])/(len(freqList)-1.)
+
+def getAxisNumbers(key):
+    """
+    Returns the axis numbers of a WCS keyword like CDELT5 or PC3_5, or
+    an empty list for other keywords.
+    """
+    match = re.match(r'^(NAXIS|CTYPE|CRVAL|CDELT|CRPIX|CUNIT|CROTA|CNAME)(\d+)$', key)
+    if match is not None:
+        return [int(match.group(2))]
+    match = re.match(r'^(PC|CD)(\d+)_(\d+)$', key)
+    if match is not None:
+        return [int(match.group(2)), int(match.group(3))]
+    return []
+
+def getCubeHeader(templateHeader, shape, freqList, FLAG, stokes=''):
+    """
+    Returns the header of the output cube with shape (1, nchan, y, x)
+    built from the header of a single channel map. If a Stokes parameter
+    is given, the fourth axis is set to that parameter. CDELT3 is only
+    set if the channels are evenly spaced.
+    """
+    header = templateHeader.copy()
+    header['BITPIX'] = -32
+    for key in ['BSCALE', 'BZERO', 'BLANK']:
+        if key in header:
+            del header[key]
+    # Remove the keywords of all axes beyond the fourth
+    for key in list(header.keys()):
+        if any(axis > 4 for axis in getAxisNumbers(key)) and key in header:
+            del header[key]
+    header['NAXIS'] = 4
+    for i, size in enumerate([shape[-1], shape[-2], len(freqList), 1]):
+        if i == 0:
+            header.set('NAXIS1', size, after='NAXIS')
+        else:
+            header.set('NAXIS{}'.format(i+1), size, after='NAXIS{}'.format(i))
+    if FLAG == 'CRVAL3':
+        header['CRPIX3'] = 1.
+        header['CRVAL3'] = freqList[0]
+        spacing = getChannelSpacing(freqList)
+        if spacing is not None:
+            header['CDELT3'] = spacing
+    if stokes != '':
+        header['CTYPE4'] = 'STOKES'
+        header['CRVAL4'] = float(STOKES_CODES[stokes])
+        header['CRPIX4'] = 1.
+        header['CDELT4'] = 1.
+    return header
+
+def getStokesIndex(header, stokes):
     """
-    Concatenate a given list of fits files into a single cube using memory map.
-    Return the concatenated array and frequency list
+    Returns the index of a Stokes parameter along the Stokes axis of a
+    4D channel map.
     """
-    concatCube = np.memmap(memMapName, dtype='float32', mode='w+',\
-                           shape=(1, len(validFitsList), shape[-2], shape[-1]))
-    freqList = []
-    for i, name in enumerate(validFitsList):
-        tempData = pf.open(name, readonly=True)[0].data[0]
-        tempHead = pf.open(name, readonly=True)[0].header
-        freqList.append(tempHead[FLAG])
+    if header['NAXIS'] != 4 or header.get('CTYPE4', '').upper() != 'STOKES':
+        raise Exception('Fits files do not have a Stokes axis.')
+    index = int(round((STOKES_CODES[stokes] - header['CRVAL4'])/header.get('CDELT4', 1.) + \
+                      header.get('CRPIX4', 1.) - 1))
+    if index < 0 or index >= header['NAXIS4']:
+        raise Exception('Stokes {} is not in the fits files.'.format(stokes))
+    return index
+
+def getChannelPlanes(name, shape, stokesIndices=(0,)):
+    """
+    Returns the 2D image planes of a channel map as big-endian float32,
+    one for each index along its outermost axis.
+    """
+    hduList = pf.open(name, readonly=True, memmap=True)
+    planes  = []
+    for index in stokesIndices:
+        tempData = hduList[0].data[index]
         if len(shape) == 3:
-            concatCube[0, i, :] = tempData[0, :]
+            planes.append(np.array(tempData[0, :], dtype='>f4'))
         if len(shape) == 4:
-            concatCube[0, i, :] = tempData[0, 0, :]
-    return concatCube, freqList
+            planes.append(np.array(tempData[0, 0, :], dtype='>f4'))
+    hduList.close()
+    return planes
+
+def openCubeFile(outName, header):
+    """
+    Writes the header of the output cube to disk.
+    Return the open file and the byte offset of its data section.
+    """
+    if os.path.exists(outName):
+        raise Exception('Output file {} already exists.'.format(outName))
+    cubeFile = open(outName, 'wb')
+    cubeFile.write(header.tostring())
+    return cubeFile, cubeFile.tell()
+
+def writeCubePlane(cubeFile, dataOffset, index, plane):
+    """
+    Writes a channel plane at its channel index in the data section.
+    """
+    cubeFile.seek(dataOffset + index*plane.nbytes)
+    cubeFile.write(plane.tostring())
+
+def closeCubeFile(cubeFile, dataOffset, dataSize):
+    """
+    Pads the data section to a full FITS block and closes the file.
+    """
+    cubeFile.seek(dataOffset + dataSize)
+    cubeFile.write('\0'*((2880 - dataSize%2880)%2880))
+    cubeFile.close()
+
+class SpectrumCubeWriter(object):
+    """
+    Writes a spectrum-major copy of the cube with shape (y, x, nchan) to
+    a memory-mappable .npy file, so the spectrum of each pixel is stored
+    contiguously. Planes are buffered in groups of chunkSize channels
+    and each group is written as one transposed block. Every group
+    touches the whole file, so larger groups mean fewer passes over it
+    at the cost of chunkSize planes of memory.
+    """
+    def __init__(self, name, shape, nChan, chunkSize=1):
+        self.nChan = nChan
+        self.chunkSize = chunkSize
+        self.cube = np.lib.format.open_memmap(name, mode='w+', dtype='float32',
+                                              shape=(shape[-2], shape[-1], nChan))
+        self.buffers = {}
+        self.counts = {}
+
+    def write(self, index, plane):
+        """
+        Buffers a channel plane and writes its group once it is complete.
+        """
+        chunk = index // self.chunkSize
+        start = chunk*self.chunkSize
+        stop = min(start+self.chunkSize, self.nChan)
+        if chunk not in self.buffers:
+            self.buffers[chunk] = np.empty((stop-start,)+plane.shape, dtype='float32')
+            self.counts[chunk] = 0
+        self.buffers[chunk][index-start] = plane
+        self.counts[chunk] += 1
+        if self.counts[chunk] == stop-start:
+            self.cube[:, :, start:stop] = self.buffers.pop(chunk).transpose(1, 2, 0)
+            del self.counts[chunk]
+
+    def close(self):
+        """
+        Flushes the spectrum-major cube to disk.
+        """
+        if len(self.buffers) > 0:
+            raise Exception('Spectrum-major cube is missing channels')
+        self.cube.flush()
+        del self.cube
+
+def quantizePlane(plane, quantize):
+    """
+    Scales a channel plane to 32-bit integers with a step of noise/quantize.
+    The noise is estimated from the differences between adjacent pixels.
+    Blanked pixels are stored as ZBLANK.
+    Returns the integer plane, the scale and the zero point.
+    """
+    ints = np.empty(plane.shape, dtype='>i4')
+    ints.fill(ZBLANK)
+    finite = np.isfinite(plane)
+    if not finite.any():
+        return ints, 1., 0.
+    values = plane[finite].astype(np.float64)
+    vmin, vmax = values.min(), values.max()
+    noise = 0.
+    if len(values) > 1:
+        noise = 1.4826*np.median(np.abs(np.diff(values)))/np.sqrt(2.)
+    # The scaled values must fit in the range of a 32-bit integer
+    zScale = max(noise/quantize, (vmax-vmin)/(2.**32-16))
+    if zScale == 0.:
+        zScale = 1.
+    zZero = (vmin+vmax)/2.
+    ints[finite] = np.round((values-zZero)/zScale)
+    return ints, zScale, zZero
+
+def getCompressedRowDtype(quantized, largeHeap):
+    """
+    Returns the row layout of the table of a tile-compressed cube.
+    Heaps larger than 2 GB need 64-bit (Q) descriptors.
+    """
+    if largeHeap:
+        dtype = [('count', '>i8'), ('offset', '>i8')]
+    else:
+        dtype = [('count', '>i4'), ('offset', '>i4')]
+    if quantized:
+        dtype += [('zscale', '>f8'), ('zzero', '>f8')]
+    return np.dtype(dtype)
+
+class CompressedCubeWriter(object):
+    """
+    Writes the cube as a tile-compressed FITS image (binary table
+    extension following the FITS tiled image convention) with one tile
+    per channel plane. Each plane is compressed as it arrives and
+    appended to the heap, so single planes can later be decompressed
+    without reading the rest of the cube. GZIP_2 shuffles the bytes of
+    each pixel before compressing, which works better for floats, but it
+    needs a reader that knows it, such as CFITSIO or getCompressedPlane.
+    pyfits 3.5 cannot open GZIP_2 cubes.
+    If quantize is non-zero, the planes are scaled to integers with a
+    step of noise/quantize before compressing. Otherwise the
+    compression is lossless.
+    """
+    def __init__(self, name, header, nChan, compressionType='GZIP_1', quantize=0.):
+        if os.path.exists(name):
+            raise Exception('Output file {} already exists.'.format(name))
+        if compressionType not in COMPRESSION_TYPES:
+            raise Exception('Unknown compression type {}'.format(compressionType))
+        self.name = name
+        self.imageHeader = header
+        self.nChan = nChan
+        self.compressionType = compressionType
+        self.quantize = quantize
+        # Bound the heap size by the raw size plus the gzip overhead
+        planeSize = header['NAXIS1']*header['NAXIS2']*4
+        self.largeHeap = nChan*(planeSize*1.01 + 1024) >= 2**31
+        self.rows = np.zeros(nChan, dtype=getCompressedRowDtype(quantize > 0, self.largeHeap))
+        self.written = np.zeros(nChan, dtype=bool)
+        self.rawBytes = 0
+        self.heapSize = 0
+        self.file = open(name, 'wb')
+        primary = pf.Header()
+        primary['SIMPLE'] = True
+        primary['BITPIX'] = 8
+        primary['NAXIS'] = 0
+        primary['EXTEND'] = True
+        self.file.write(primary.tostring())
+        # The number of header cards does not depend on the heap, so the
+        # header can be written once all the planes are in
+        self.headerOffset = self.file.tell()
+        self.tableOffset = self.headerOffset + len(self.getHeader(0).tostring())
+        self.heapOffset = self.tableOffset + nChan*self.rows.itemsize
+
+    def getHeader(self, maxLength):
+        """
+        Returns the header of the binary table extension.
+        """
+        header = pf.Header()
+        header['XTENSION'] = 'BINTABLE'
+        header['BITPIX'] = 8
+        header['NAXIS'] = 2
+        header['NAXIS1'] = self.rows.itemsize
+        header['NAXIS2'] = self.nChan
+        header['PCOUNT'] = self.heapSize
+        header['GCOUNT'] = 1
+        header['TFIELDS'] = len(self.rows.dtype.names)-1
+        header['TTYPE1'] = 'COMPRESSED_DATA'
+        header['TFORM1'] = '1{}B({})'.format('Q' if self.largeHeap else 'P', maxLength)
+        if self.quantize > 0:
+            header['TTYPE2'] = 'ZSCALE'
+            header['TFORM2'] = '1D'
+            header['TTYPE3'] = 'ZZERO'
+            header['TFORM3'] = '1D'
+        header['ZIMAGE'] = True
+        header['ZTENSION'] = 'IMAGE'
+        header['ZBITPIX'] = -32
+        # The degenerate fourth axis is dropped so pyfits can read the cube
+        header['ZNAXIS'] = 3
+        for i in range(1, 4):
+            header['ZNAXIS{}'.format(i)] = self.imageHeader['NAXIS{}'.format(i)]
+        header['ZTILE1'] = self.imageHeader['NAXIS1']
+        header['ZTILE2'] = self.imageHeader['NAXIS2']
+        header['ZTILE3'] = 1
+        header['ZCMPTYPE'] = self.compressionType
+        header['ZPCOUNT'] = 0
+        header['ZGCOUNT'] = 1
+        if self.quantize > 0:
+            header['ZQUANTIZ'] = 'NO_DITHER'
+            header['ZBLANK'] = ZBLANK
+        else:
+            header['ZQUANTIZ'] = 'NONE'
+        for card in self.imageHeader.cards:
+            if card.keyword in ['SIMPLE', 'BITPIX', 'EXTEND', 'WCSAXES'] or \
+               card.keyword.startswith('NAXIS') or \
+               any(axis > 3 for axis in getAxisNumbers(card.keyword)):
+                continue
+            header.append(card)
+        return header
+
+    def write(self, index, plane):
+        """
+        Compresses a channel plane and appends it to the heap.
+        """
+        if self.quantize > 0:
+            data, zScale, zZero = quantizePlane(plane, self.quantize)
+            self.rows[index]['zscale'] = zScale
+            self.rows[index]['zzero'] = zZero
+        else:
+            data = np.asarray(plane, dtype='>f4')
+        if self.compressionType == 'GZIP_2':
+            raw = data.view('u1').reshape(-1, 4).T.tostring()
+        else:
+            raw = data.tostring()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        tile = compressor.compress(raw) + compressor.flush()
+        self.file.seek(self.heapOffset + self.heapSize)
+        self.file.write(tile)
+        self.rows[index]['count'] = len(tile)
+        self.rows[index]['offset'] = self.heapSize
+        self.written[index] = True
+        self.heapSize += len(tile)
+        self.rawBytes += plane.nbytes
+
+    def close(self):
+        """
+        Writes the header and the tile table, pads the file and reports
+        the compression ratio.
+        """
+        if not self.written.all():
+            raise Exception('Compressed cube is missing channels')
+        self.file.seek(self.headerOffset)
+        self.file.write(self.getHeader(self.rows['count'].max()).tostring())
+        self.file.write(self.rows.tostring())
+        dataSize = self.nChan*self.rows.itemsize + self.heapSize
+        self.file.seek(self.tableOffset + dataSize)
+        self.file.write('\0'*((2880 - dataSize%2880)%2880))
+        self.file.close()
+        fileSize = os.path.getsize(self.name)
+        print 'INFO: Wrote {} with {} compression: {:.1f} MB -> {:.1f} MB (ratio {:.2f})'.\
+              format(self.name, self.compressionType, self.rawBytes/1.E6, fileSize/1.E6, \
+                     float(self.rawBytes)/fileSize)
+
+def getCompressedPlane(name, index):
+    """
+    Reads a single channel plane from a cube written by
+    CompressedCubeWriter without decompressing the rest of the cube.
+    """
+    hduList = pf.open(name, disable_image_compression=True)
+    header = hduList[1].header
+    tableOffset = hduList.fileinfo(1)['datLoc']
+    hduList.close()
+    quantized = header['TFIELDS'] > 1
+    rowDtype = getCompressedRowDtype(quantized, header['TFORM1'].startswith('1Q'))
+    heapOffset = tableOffset + header.get('THEAP', header['NAXIS1']*header['NAXIS2'])
+    cubeFile = open(name, 'rb')
+    cubeFile.seek(tableOffset + index*rowDtype.itemsize)
+    row = np.fromstring(cubeFile.read(rowDtype.itemsize), dtype=rowDtype)[0]
+    cubeFile.seek(heapOffset + row['offset'])
+    raw = zlib.decompress(cubeFile.read(row['count']), 31)
+    cubeFile.close()
+    if header['ZCMPTYPE'] == 'GZIP_2':
+        raw = np.fromstring(raw, dtype='u1').reshape(4, -1).T.tostring()
+    if quantized:
+        data = np.fromstring(raw, dtype='>i4')
+        plane = np.where(data == header['ZBLANK'], np.nan, \
+                         data*row['zscale'] + row['zzero']).astype('float32')
+    else:
+        plane = np.fromstring(raw, dtype='>f4')
+    return plane.reshape(header['ZNAXIS2'], header['ZNAXIS1'])
+
+def readChannels(taskQueue, planeQueue, shape):
+    """
+    Reader thread: decodes channel maps from taskQueue and puts
+    (index, [(output, plane), ...]) on planeQueue until no tasks are
+    left. A failed read puts (index, exception) on the queue instead,
+    with the name of the file in the message.
+    """
+    while True:
+        try:
+            i, name, planeSel = taskQueue.get_nowait()
+        except Queue.Empty:
+            return
+        try:
+            planes = getChannelPlanes(name, shape, [sel[0] for sel in planeSel])
+            planeQueue.put((i, zip([sel[1] for sel in planeSel], planes)))
+        except Exception as e:
+            planeQueue.put((i, Exception('Unable to read {}: {}'.format(name, e))))
+
+def ingestChannels(tasks, shape, outputs, nReaders=1, queueSize=8):
+    """
+    Reads the channel maps in tasks and writes their planes into one or
+    more open cubes. Each task is (channel index, name, planeSel), where
+    planeSel lists (Stokes index in the file, output number) for each
+    plane to copy. outputs lists (writePlane, specWriter) for each
+    output cube, where writePlane(index, plane) writes a plane into the
+    cube and specWriter may be None.
+    nReaders threads read the channel maps concurrently and pass the
+    planes through a queue of at most queueSize maps, so memory is
+    bounded by a few planes.
+    """
+    taskQueue = Queue.Queue()
+    for task in tasks:
+        taskQueue.put(task)
+    planeQueue = Queue.Queue(maxsize=queueSize)
+    readers = []
+    for i in range(nReaders):
+        reader = threading.Thread(target=readChannels, args=(taskQueue, planeQueue, shape))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+    startTime = time.time()
+    nBytes = 0
+    for n in range(len(tasks)):
+        i, planes = planeQueue.get()
+        if isinstance(planes, Exception):
+            raise planes
+        for outNo, plane in planes:
+            writePlane, specWriter = outputs[outNo]
+            writePlane(i, plane)
+            if specWriter is not None:
+                specWriter.write(i, plane)
+            nBytes += plane.nbytes
+    for reader in readers:
+        reader.join()
+    elapsed = max(time.time() - startTime, 1.E-6)
+    print 'INFO: Ingested {:.1f} MB in {:.1f} s ({:.1f} MB/s) using {} reader threads'.\
+          format(nBytes/1.E6, elapsed, nBytes/1.E6/elapsed, nReaders)
+
+def getSpectrumChunkSize(shape, nChan, nCubes, maxMemory):
+    """
+    Returns the number of channels per group of a SpectrumCubeWriter such
+    that the groups of nCubes writers fit in maxMemory MB.
+    """
+    planeSize = shape[-1]*shape[-2]*4
+    return int(min(nChan, max(1, maxMemory*1024.**2//(planeSize*nCubes))))
+
+def concatenateStreaming(tasks, nChan, shape, headers, outNames, nReaders=1,
+                         specNames=None, compression='', quantize=0., specMemory=512.):
+    """
+    Concatenate the channel maps listed in tasks (see ingestChannels)
+    into one cube on disk for each output name. The headers are written
+    first and the channel planes are then written straight into the data
+    sections. If a compression type is given, tile-compressed cubes are
+    written instead. If specNames are given, spectrum-major copies of
+    the cubes are written in the same pass, buffering at most specMemory
+    MB of channel planes.
+    """
+    outputs = []
+    cubes = []
+    if specNames is not None:
+        chunkSize = getSpectrumChunkSize(shape, nChan, len(outNames), specMemory)
+        print 'INFO: Buffering {} channels per spectrum-major cube'.format(chunkSize)
+    try:
+        for k, outName in enumerate(outNames):
+            specWriter = None
+            if specNames is not None:
+                specWriter = SpectrumCubeWriter(specNames[k], shape, nChan, chunkSize)
+            if compression != '':
+                cube = CompressedCubeWriter(outName, headers[k], nChan, compression, quantize)
+                outputs.append((cube.write, specWriter))
+            else:
+                cube = openCubeFile(outName, headers[k])
+                outputs.append((partial(writeCubePlane, *cube), specWriter))
+            cubes.append(cube)
+        ingestChannels(tasks, shape, outputs, nReaders)
+        for cube in cubes:
+            if isinstance(cube, CompressedCubeWriter):
+                cube.close()
+    finally:
+        for cube in cubes:
+            if isinstance(cube, CompressedCubeWriter):
+                cube.file.close()
+            else:
+                closeCubeFile(cube[0], cube[1], nChan*shape[-1]*shape[-2]*4)
+    for k, output in enumerate(outputs):
+        if output[1] is not None:
+            output[1].close()
+            print 'INFO: Wrote the spectrum-major cube to {}'.format(specNames[k])
+
+def getOutputName(name, stokes):
+    """
+    Inserts the Stokes parameter into an output filename.
+    """
+    if stokes == '':
+        return name
+    root, ext = os.path.splitext(name)
+    return '{}-{}{}'.format(root, stokes, ext)
+
+def getAppendOrder(freqList, newChannels):
+    """
+    Returns the (frequency, name) pairs of new channels in the order in
+    which they continue the frequency list of a cube. Raises an exception
+    if they cannot be appended without breaking the frequency order.
+    """
+    for reverse in [False, True]:
+        ordered = sorted(newChannels, reverse=reverse)
+        steps = np.diff(freqList + [freq for freq, name in ordered])
+        if (steps > 0).all() or (steps < 0).all():
+            return ordered
+    raise Exception('Channels {} cannot be appended: their frequencies must all lie '.\
+                    format(', '.join([name for freq, name in newChannels]))+\
+                    'beyond the last channel of the cube. Rebuild the cube instead.')
+
+def updateCube(channelIndex, shape, outName, freqFile, FLAG, nReaders=1):
+    """
+    Updates an existing cube in place. Channel maps whose frequency is
+    already in the frequency list of the cube replace the corresponding
+    plane if they are newer than the cube. All other channel maps are
+    appended to the end of the cube and the frequency list, which must
+    stay monotonic. CDELT3 is only updated if the channels stay evenly
+    spaced. The header is written after the planes and the frequency list
+    is replaced once the cube is closed, so an interrupted update leaves
+    the cube consistent with its frequency list.
+    """
+    hduList = pf.open(outName)
+    header  = hduList[0].header.copy()
+    headerSize = hduList.fileinfo(0)['datLoc']
+    hduList.close()
+    if header['BITPIX'] != -32 or header['NAXIS'] != 4 or header['NAXIS4'] != 1 or \
+       (header['NAXIS2'], header['NAXIS1']) != tuple(shape[-2:]):
+        raise Exception('Cube {} is incompatible with the input fits files'.format(outName))
+    if not os.path.exists(freqFile):
+        raise Exception('Frequency list {} of the cube does not exist'.format(freqFile))
+    freqList = [float(line) for line in open(freqFile) if line.strip() != '']
+    if len(freqList) != header['NAXIS3']:
+        raise Exception('Frequency list {} does not match cube {}'.format(freqFile, outName))
+
+    # Sort the channel maps into replaced and new channels
+    cubeTime = os.path.getmtime(outName)
+    tasks = []
+    newChannels = []
+    for name, chanShape, freq, chanHeader in channelIndex:
+        match = np.nonzero(np.isclose(freqList, freq, rtol=1.E-9, atol=0.))[0]
+        if len(match) > 0:
+            if os.path.getmtime(name) > cubeTime:
+                tasks.append((match[0], name, [(0, 0)]))
+        else:
+            newChannels.append((freq, name))
+    newFreqs = []
+    if len(newChannels) > 0:
+        newChannels = getAppendOrder(freqList, newChannels)
+        newFreqs = [freq for freq, name in newChannels]
+        for k, (freq, name) in enumerate(newChannels):
+            tasks.append((len(freqList)+k, name, [(0, 0)]))
+    print 'INFO: Replacing {} channels and appending {} channels to {}'.\
+          format(len(tasks)-len(newFreqs), len(newFreqs), outName)
+    if len(tasks) == 0:
+        return
+
+    # Update the header in place
+    freqList += newFreqs
+    header['NAXIS3'] = len(freqList)
+    spacing = getChannelSpacing(freqList)
+    if FLAG == 'CRVAL3' and spacing is not None and 'CDELT3' in header:
+        header['CDELT3'] = spacing
+    elif FLAG == 'CRVAL3' and len(newFreqs) > 0:
+        print 'WARNING: The channels of {} are not evenly spaced in frequency. '.format(outName)+\
+              'CDELT3 does not describe the channels; use {} instead.'.format(freqFile)
+    if len(header.tostring()) != headerSize:
+        raise Exception('Unable to update the header of {} in place'.format(outName))
+
+    # Write the extended frequency list next to the old one
+    text = open(freqFile).read()
+    if text != '' and not text.endswith('\n'):
+        text += '\n'
+    fd, tmpName = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(freqFile)))
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(text)
+            for line in newFreqs:
+                f.write(str(line)+'\n')
+        finally:
+            f.close()
+        shutil.copymode(freqFile, tmpName)
+
+        # Planes appended beyond NAXIS3 are ignored until the header is written
+        cubeFile = open(outName, 'r+b')
+        try:
+            ingestChannels(tasks, shape, [(partial(writeCubePlane, cubeFile, headerSize), None)], \
+                           nReaders)
+            cubeFile.seek(0)
+            cubeFile.write(header.tostring())
+        finally:
+            closeCubeFile(cubeFile, headerSize, len(freqList)*shape[-1]*shape[-2]*4)
+
+        # Keep the frequency list in sync with the cube
+        os.rename(tmpName, freqFile)
+    except:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
 
 def main(options):
     """
     Main function
     """
-    memMapName = 'memMap'
-
     # Check user input
     if options.inp == '':
         raise Exception('An input glob string must be specified.')
     if options.out == '':
         raise Exception('An output filename must be specified.')
+    if options.compress != '' and options.compress.upper() not in COMPRESSION_TYPES:
+        raise Exception('Compression type must be one of {}'.format(', '.join(COMPRESSION_TYPES)))
 
-    # Get the list of FITS files
-    fileList = sorted(glob.glob(options.inp))
-    print fileList
-    validFitsList = getValidFitsList(fileList)
-    print 'INFO: Identified {} fits files from {} files selected by input string'.\
-          format(len(validFitsList), len(fileList))
+    # Get the frequency of each channel from the headers
+    if options.restfrq:
+        FLAG = 'RESTFREQ'
+    else:
+        FLAG = 'CRVAL3'
 
-    # Proceed with the execution if we have non-zero FITS files
-    if len(validFitsList) == 0:
-        raise Exception('No valid fits files were selected by the glob string')
+    # Get the list of FITS files for each Stokes parameter
+    stokesList = list(options.stokes.upper())
+    for stokes in stokesList:
+        if stokes not in STOKES_CODES:
+            raise Exception('Unknown Stokes parameter {}'.format(stokes))
+    if '{stokes}' in options.inp:
+        if len(stokesList) == 0:
+            raise Exception('Stokes parameters must be specified for a {stokes} glob.')
+        globList = [options.inp.replace('{stokes}', stokes) for stokes in stokesList]
+    else:
+        globList = [options.inp]
+    channelIndexList = []
+    for globString in globList:
+        fileList = sorted(glob.glob(globString))
+        print fileList
+        channelIndex = getChannelIndex(fileList, FLAG, int(options.threads))
+        print 'INFO: Identified {} fits files from {} files selected by input string'.\
+              format(len(channelIndex), len(fileList))
+        # Proceed with the execution if we have non-zero FITS files
+        if len(channelIndex) == 0:
+            raise Exception('No valid fits files were selected by the glob string')
+        channelIndexList.append(channelIndex)
+    channelIndex = channelIndexList[0]
 
     # Check if the list of supplied fits files have the same shape
-    shape = checkFitsShape(validFitsList)
+    shape = checkFitsShape([entry for index in channelIndexList for entry in index])
     print 'INFO: All fits files have shape {}'.format(shape)
     if len(shape) not in [3, 4]:
         raise Exception('Fits files have unknown shape')
+    freqList = [entry[2] for entry in channelIndex]
+    for index in channelIndexList[1:]:
+        if not np.allclose([entry[2] for entry in index], freqList, rtol=1.E-9, atol=0.):
+            raise Exception('Fits files of different Stokes parameters have different frequencies')
     
-    # Merge the cubes
-    if options.restfrq:
-        FLAG = 'RESTFREQ'
-    else:
-        FLAG = 'CRVAL3'
-    finalCube, freqList = concatenateWithMemMap(validFitsList, shape, memMapName, FLAG)
-    
+    # Update an existing cube instead of writing a new one
+    if options.append and os.path.exists(options.out):
+        if options.specOut != '':
+            raise Exception('A spectrum-major cube cannot be written in append mode.')
+        if len(stokesList) > 0:
+            raise Exception('Multiple Stokes cubes cannot be updated in append mode.')
+        if options.compress != '':
+            raise Exception('Compressed cubes cannot be updated in append mode.')
+        updateCube(channelIndex, shape, options.out, options.freq, FLAG, \
+                   int(options.readers))
+        return
+
+    # A linear spectral axis can only describe evenly spaced channels
+    if FLAG == 'CRVAL3' and len(freqList) > 1 and getChannelSpacing(freqList) is None:
+        print 'WARNING: The channels are not evenly spaced in frequency. CDELT3 of the '+\
+              'output cube does not describe the channels; use {} instead.'.format(options.freq)
+
     # Write the frequency list to disk
     f = open(options.freq, "w")
     for line in freqList:
         f.write(str(line)+'\n')
     f.close()
 
-    # Get a template header from a fits file
-    header = pf.open(validFitsList[0], readonly=True)[0].header
-    print 'INFO: Writing the concatenated fits file to {}'.format(options.out)
-    hdu = pf.PrimaryHDU(data=finalCube, header=header)
-    hdu.writeto(options.out)
-    os.remove(memMapName)
+    # Get the header and the planes to copy for each output cube
+    if len(stokesList) == 0:
+        stokesList = ['']
+        tasks = [(i, entry[0], [(0, 0)]) for i, entry in enumerate(channelIndex)]
+    elif '{stokes}' in options.inp:
+        # One glob per Stokes parameter
+        tasks = [(i, entry[0], [(0, k)]) for k, index in enumerate(channelIndexList) \
+                 for i, entry in enumerate(index)]
+    else:
+        # Stokes parameters are along the outermost axis of the input files
+        if len(shape) != 3:
+            raise Exception('Fits files have unknown shape')
+        for entry in channelIndex:
+            for key in ['NAXIS4', 'CRVAL4', 'CDELT4', 'CRPIX4']:
+                if entry[3].get(key) != channelIndex[0][3].get(key):
+                    raise Exception('Fits file {} has an incompatible Stokes axis'.format(entry[0]))
+        stokesIndices = [getStokesIndex(channelIndex[0][3], stokes) for stokes in stokesList]
+        tasks = [(i, entry[0], zip(stokesIndices, range(len(stokesList)))) \
+                 for i, entry in enumerate(channelIndex)]
+    if len(channelIndexList) == 1:
+        channelIndexList = channelIndexList*len(stokesList)
+    headers  = [getCubeHeader(index[0][3], shape, freqList, FLAG, stokes) \
+                for index, stokes in zip(channelIndexList, stokesList)]
+    outNames = [getOutputName(options.out, stokes) for stokes in stokesList]
+    specNames = None
+    if options.specOut != '':
+        specNames = [getOutputName(options.specOut, stokes) for stokes in stokesList]
+    
+    # Merge the cubes
+    print 'INFO: Writing the concatenated fits files to {}'.format(', '.join(outNames))
+    concatenateStreaming(tasks, len(freqList), shape, headers, outNames, \
+                         int(options.readers), specNames, options.compress.upper(), \
+                         float(options.quantize), float(options.specMemory))
 
 if __name__ == '__main__':
     opt = optparse.OptionParser()
@@ -127,5 +789,26 @@ if __name__ == '__main__':
     opt.add_option('-r', '--restfrq', help='Frequency is stored in RESTFRQ '+
                    'instead of CRVAL3 [default: False]', default=False, 
                    action='store_true')
+    opt.add_option('-j', '--threads', help='Number of threads used to scan the '+
+                   'fits headers [default: 8]', default='8')
+    opt.add_option('-n', '--readers', help='Number of threads used to read the '+
+                   'channel maps [default: 4]', default='4')
+    opt.add_option('-a', '--append', help='Append new channels to an existing output '+
+                   'cube and replace channels that are newer than the cube '+
+                   '[default: False]', default=False, action='store_true')
+    opt.add_option('-s', '--specOut', help='Filename of an additional spectrum-major '+
+                   '(y, x, nchan) cube in .npy format [default: none]', default='')
+    opt.add_option('-m', '--specMemory', help='Memory in MB used to buffer channel planes '+
+                   'for the spectrum-major cubes. Each buffered group of channels is '+
+                   'written in one pass over the file [default: 512]', default='512')
+    opt.add_option('-c', '--compress', help='Write tile-compressed cubes with one tile '+
+                   'per channel plane using GZIP_1 or GZIP_2. GZIP_2 compresses better but '+
+                   'cannot be read by pyfits 3.5 [default: none]', default='')
+    opt.add_option('-q', '--quantize', help='Quantize the compressed planes with a step '+
+                   'of noise/quantize. 0 means lossless [default: 0]', default='0')
+    opt.add_option('-p', '--stokes', help='Stokes parameters to build cubes for in a single '+
+                   'pass, e.g. IQU. The input glob may contain a {stokes} placeholder; '+
+                   'otherwise the Stokes axis of the input files is used. Output names '+
+                   'get a -<Stokes> suffix [default: none]', default='')
     inOpts, arguments = opt.parse_args()
     main(inOpts)
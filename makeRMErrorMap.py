@@ -9,6 +9,7 @@ Written by Sarrvesh S. Sridhar
  
 """
 import optparse
+from multiprocessing import Pool
 try:
     import pyfits as pf
 except ImportError:
@@ -22,6 +23,115 @@ try:
 except ImportError:
     raise Exception('Unable to import Scipy.')
 
+def getChannelVariance(cube):
+    """
+    Computes the variance along the frequency axis of a (nchan, y, x) cube
+    one channel plane at a time using Welford's running update, so only a
+    few planes are held in memory when the cube is memory-mapped.
+    """
+    mean = np.zeros(cube.shape[1:], dtype=np.float64)
+    M2   = np.zeros(cube.shape[1:], dtype=np.float64)
+    for n in range(cube.shape[0]):
+        plane = np.asarray(cube[n], dtype=np.float64)
+        delta = plane - mean
+        mean += delta/(n+1)
+        M2   += delta*(plane - mean)
+    return M2/cube.shape[0]
+
+def getRobustVariance(spectra, method='mad', nSigma=3., maxIter=10):
+    """
+    Returns a robust estimate of the noise variance along the frequency axis
+    of one or more (nchan, y, x) blocks, e.g. the same block of Q and U.
+    Each block is centred on its own median (mad) or sigma-clipped mean
+    (clip), and the residuals of all blocks are combined into one estimate.
+    Blanked channels are ignored.
+    """
+    spectra = [np.asarray(s, dtype=np.float64) for s in spectra]
+    if method == 'mad':
+        resid = np.concatenate([s - np.nanmedian(s, axis=0) for s in spectra])
+        return np.square(1.4826*np.nanmedian(np.absolute(resid), axis=0))
+    # Iterative sigma clipping of the joint residuals
+    masks = [np.isfinite(s) for s in spectra]
+    for i in range(maxIter):
+        resid = []
+        for s, mask in zip(spectra, masks):
+            mean = np.where(mask, s, 0.).sum(axis=0)/np.maximum(mask.sum(axis=0), 1)
+            resid.append(np.where(mask, s - mean, 0.))
+        count = sum(mask.sum(axis=0) for mask in masks)
+        var = sum(np.square(r).sum(axis=0) for r in resid)/np.maximum(count, 1)
+        newMasks = [mask & (np.absolute(r) <= nSigma*np.sqrt(var)) \
+                    for mask, r in zip(masks, resid)]
+        if all(np.array_equal(m1, m2) for m1, m2 in zip(masks, newMasks)):
+            break
+        masks = newMasks
+    var[count == 0] = np.nan
+    return var
+
+PRODUCTS = ['varInQ', 'varInRM', 'noiseInRM']
+RM_UNITS = {'varInRM': 'rad2/m4', 'noiseInRM': 'rad/m2'}
+
+workerData = {}
+
+def initWorker(fileNames):
+    """
+    Opens the memory-mapped cubes in each worker process of the pool.
+    """
+    workerData['cubes'] = [pf.open(name, memmap=True)[0].data for name in fileNames]
+
+def getBlockVariance(args):
+    """
+    Robust noise variance of the rows start:stop of the cubes.
+    """
+    start, stop, method, nSigma = args
+    spectra = [cube[:, start:stop] for cube in workerData['cubes']]
+    return start, getRobustVariance(spectra, method, nSigma)
+
+def getBlockSize(shape, nCubes, maxMemory):
+    """
+    Returns the number of image rows of nCubes (nchan, y, x) cubes that
+    the robust estimators can process within about maxMemory MB. The
+    estimators hold about four float64 copies of a block.
+    """
+    rowSize = 4*8*nCubes*shape[0]*shape[2]
+    return int(min(shape[1], max(1, maxMemory*1024.**2//rowSize)))
+
+def getNoiseVariance(fileNames, shape, method='mad', nSigma=3., maxMemory=256., workers=1):
+    """
+    Computes the robust noise variance map of one or more (nchan, y, x)
+    cubes in blocks of rows, spread over a pool of workers. The blocks
+    are sized so that each worker uses about maxMemory MB.
+    """
+    blockSize = getBlockSize(shape, len(fileNames), maxMemory)
+    print 'INFO: Processing {} rows at a time'.format(blockSize)
+    blocks = [(start, min(start+blockSize, shape[1]), method, nSigma) \
+              for start in range(0, shape[1], blockSize)]
+    variance = np.zeros(shape[1:])
+    if workers > 1:
+        pool = Pool(workers, initializer=initWorker, initargs=(fileNames,))
+        try:
+            for start, blockVar in pool.imap_unordered(getBlockVariance, blocks):
+                variance[start:start+blockVar.shape[0]] = blockVar
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        initWorker(fileNames)
+        for block in blocks:
+            start, blockVar = getBlockVariance(block)
+            variance[start:start+blockVar.shape[0]] = blockVar
+    return variance
+
+def writeProduct(name, data, header, dtype):
+    """
+    Writes one output map to <name>.fits with the polarized intensity header.
+    """
+    outHeader = header.copy()
+    if name in RM_UNITS:
+        outHeader['BUNIT'] = RM_UNITS[name]
+    hdu = pf.PrimaryHDU(data=data.astype(dtype, copy=False), header=outHeader)
+    hdu.writeto(name+'.fits', clobber=True)
+    del hdu
+
 def main(options):
     if options.qFile == '':
         raise Exception('An input Q or U file must be specified.')
@@ -29,10 +139,19 @@ def main(options):
         raise Exception('A file containing frequency list must be specified.')
     if options.polInt == '':
         raise Exception('An input polarized intensity map must be specified.')
+    if options.method not in ['var', 'mad', 'clip']:
+        raise Exception('Noise estimator must be one of var, mad or clip.')
+    products = options.products.split(',')
+    for name in products:
+        if name not in PRODUCTS:
+            raise Exception('Output products must be among {}.'.format(', '.join(PRODUCTS)))
+    dtype = np.float32 if options.float32 else np.float64
     # If all input options are valid:
     print 'INFO: Reading the input files'
     try:
-        qData   = pf.open(options.qFile)[0].data
+        qData   = pf.open(options.qFile, memmap=True)[0].data
+        if options.uFile != '':
+            uData = pf.open(options.uFile, memmap=True)[0].data
         pData   = pf.open(options.polInt)[0].data
         header  = pf.open(options.polInt)[0].header
         freqFile = open(options.freq)
@@ -43,6 +162,8 @@ def main(options):
     print 'Stokes U:', pData.shape
     if qData.shape[1] != pData.shape[1] or qData.shape[2] != pData.shape[2]:
         raise Exception('Input fits have different image dimensions.')
+    if options.uFile != '' and uData.shape != qData.shape:
+        raise Exception('Stokes Q and U cubes have different dimensions.')
     # Estimate the number of frequencies listed in the freq file
     freqArray   = []
     for line in freqFile:
@@ -58,35 +179,57 @@ def main(options):
     varLambda2   = np.absolute(np.var(lambda_pow2))
 
     # Estimate the noise in the Q-cube along each line of sight
-    print 'INFO: Estimating noise variance in Q'
     varInQ     = np.zeros(pData.shape)
-    for i in range(pData.shape[1]):
-        for j in range(pData.shape[2]):
-            varInQ[0,i,j] = np.absolute(np.var(qData[:,i,j]))
-    hdu = pf.PrimaryHDU(data=varInQ, header=header)
-    hdu.writeto('varInQ.fits', clobber=True)
-    del hdu
+    if options.method == 'var':
+        print 'INFO: Estimating noise variance in Q'
+        varInQ[0]  = np.absolute(getChannelVariance(qData))
+        if options.uFile != '':
+            print 'INFO: Estimating noise variance in U'
+            varInQ[0] = (varInQ[0] + np.absolute(getChannelVariance(uData)))/2.
+    else:
+        fileNames = [options.qFile]
+        if options.uFile != '':
+            fileNames.append(options.uFile)
+        print 'INFO: Estimating noise variance in {} using {} with {} workers'.\
+              format(' and '.join(fileNames), options.method, options.workers)
+        varInQ[0] = getNoiseVariance(fileNames, qData.shape, options.method, \
+                                     float(options.nSigma), float(options.blockMemory), \
+                                     int(options.workers))
+    if 'varInQ' in products:
+        writeProduct('varInQ', varInQ, header, dtype)
     
-    # Compute the variance in RM using equation 2.73 in Brentjens' thesis
-    print 'INFO: Computing variance of RM'
-    denom = 4*(len(freqArray)-2) * np.square(pData) * varLambda2
-    varInRM = np.absolute(np.divide(varInQ, denom))
-    hdu = pf.PrimaryHDU(data=varInRM)
-    hdu.writeto('varInRM.fits', clobber=True)
-    del hdu
-    print varInRM.shape
-    
-    # Compute noise in RM
+    # Compute the variance and the noise in RM using equation 2.73 in
+    # Brentjens' thesis. The maps are computed in place in a single buffer.
     print 'INFO: Computing standard deviation in RM'
-    noiseInRM = np.sqrt(varInRM)
-    hdu = pf.PrimaryHDU(data=noiseInRM, header=header)
-    hdu.writeto('noiseInRM.fits', clobber=True)
-    del hdu
+    rmMap = np.square(np.asarray(pData, dtype=dtype))
+    rmMap *= 4*(len(freqArray)-2) * varLambda2
+    np.divide(varInQ, rmMap, out=rmMap)
+    np.absolute(rmMap, out=rmMap)
+    if 'varInRM' in products:
+        writeProduct('varInRM', rmMap, header, dtype)
+    if 'noiseInRM' in products:
+        np.sqrt(rmMap, out=rmMap)
+        writeProduct('noiseInRM', rmMap, header, dtype)
 
 if __name__ == '__main__':
     opt = optparse.OptionParser()
     opt.add_option('-f', '--freq', help='Frequency list', default='')
     opt.add_option('-q', '--qFile', help='Stokes Q or U file to estimate noise', default='')
     opt.add_option('-p', '--polInt', help='Polarized intensity map', default='')
+    opt.add_option('-u', '--uFile', help='Stokes U file to estimate the noise jointly with '+
+                   'the Q file [default: none]', default='')
+    opt.add_option('-m', '--method', help='Noise estimator: var, mad (median absolute '+
+                   'deviation) or clip (iterative sigma clipping) [default: var]', default='var')
+    opt.add_option('-s', '--nSigma', help='Clipping threshold for the clip estimator '+
+                   '[default: 3]', default='3')
+    opt.add_option('-b', '--blockMemory', help='Memory in MB used by each worker of the '+
+                   'robust estimators. The cubes are processed in blocks of rows that fit '+
+                   'in it [default: 256]', default='256')
+    opt.add_option('-j', '--workers', help='Number of worker processes for the robust '+
+                   'estimators [default: 1]', default='1')
+    opt.add_option('-w', '--products', help='Comma-separated list of output maps to write '+
+                   '[default: varInQ,varInRM,noiseInRM]', default='varInQ,varInRM,noiseInRM')
+    opt.add_option('-t', '--float32', action='store_true', help='Write the output maps as '+
+                   'float32 [default: float64]', default=False)
     options, arguments = opt.parse_args()
     main(options)
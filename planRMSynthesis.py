@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+planRMSynthesis.py
+
+Compares RM synthesis parameters of many candidate channel setups. For
+every configuration in the input table, the script computes the maximum
+Faraday depth (as in getRMParam.py), the RMSF FWHM and maximum scale (as
+in getRMSF.py) and the level of the first sidelobe of the RMSF, and prints
+a sortable table. The nChanTotal column of the output counts all channels
+of a configuration.
+
+The input table is whitespace separated with a header line naming the
+columns. Lines starting with # are ignored. Recognised columns:
+    name       Name of the configuration
+    subbands   LOFAR subband list, e.g. 104..136,138..163,349 (only the
+               first beam of a ;-separated list is used)
+    zone       Nyquist zone of the subbands [default: 2]
+    clock      Station clock in MHz [default: 200]
+    nChan      Channels per subband [default: 1]
+    freqs      Frequency ranges in MHz when no subbands are given,
+               e.g. 120-150,155-168
+    chanWidth  Channel width in MHz for the frequency ranges
+Use - for cells that do not apply to a configuration.
+"""
+import optparse
+import sys
+try:
+    import numpy as np
+except ImportError:
+    raise Exception('Unable to import Numpy.')
+from getRMParam import getMaxPhi
+c = 299792458. # [m/s]
+
+COLUMNS = ['name', 'nChanTotal', 'minFreq', 'maxFreq', 'maxPhi', 'fwhm', 'maxScale', 'sidelobe']
+
+def parseSubbands(subbands):
+    """
+    Returns the subband numbers in a LOFAR subband list like 104..136,349.
+    """
+    numbers = []
+    for item in subbands.split(';')[0].split(','):
+        if '..' in item:
+            start, stop = item.split('..')
+            numbers.extend(range(int(start), int(stop)+1))
+        elif item != '':
+            numbers.append(int(item))
+    return np.unique(numbers)
+
+def getValue(config, key, default=None):
+    """
+    Returns a cell of a configuration, or default if it is missing or -.
+    """
+    value = config.get(key, '-')
+    if value == '-':
+        return default
+    return value
+
+def getChannelFreqs(config):
+    """
+    Returns the channel centre frequencies and widths [Hz] of a
+    configuration.
+    """
+    if getValue(config, 'subbands') is not None:
+        clock = float(getValue(config, 'clock', 200.))*1.E6
+        zone = int(getValue(config, 'zone', 2))
+        nChan = int(getValue(config, 'nChan', 1))
+        sbWidth = clock/1024.
+        chanWidth = sbWidth/nChan
+        centres = (zone-1)*clock/2. + parseSubbands(config['subbands'])*sbWidth
+        offsets = (np.arange(nChan) - (nChan-1)/2.)*chanWidth
+        freqs = (centres[:, np.newaxis] + offsets).ravel()
+    else:
+        if getValue(config, 'freqs') is None or getValue(config, 'chanWidth') is None:
+            raise Exception('Configuration {} needs subbands or freqs and chanWidth.'.\
+                            format(getValue(config, 'name', '')))
+        chanWidth = float(config['chanWidth'])*1.E6
+        freqs = []
+        for band in config['freqs'].split(','):
+            low, high = [float(value)*1.E6 for value in band.split('-')]
+            freqs.append(np.arange(low+chanWidth/2., high, chanWidth))
+        freqs = np.concatenate(freqs)
+    return freqs, np.repeat(chanWidth, len(freqs))
+
+def readConfigTable(fileName):
+    """
+    Reads the configuration table into a list of dictionaries.
+    """
+    configs = []
+    columns = None
+    with open(fileName) as f:
+        for line in f:
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            if columns is None:
+                columns = line.split()
+                continue
+            values = line.split()
+            if len(values) != len(columns):
+                raise Exception('Line "{}" does not match the table columns.'.format(line.strip()))
+            configs.append(dict(zip(columns, values)))
+    return configs
+
+def getSidelobeLevels(lam2, weights, fwhm, nSamples=400, maxFWHM=10., chunkSize=None):
+    """
+    Returns the level of the first sidelobe of |R(phi)| for each row of
+    the zero-padded (nConfig, nChanMax) lambda^2 and weight arrays. The
+    RMSFs of all configurations are sampled at once on phi = u*fwhm for
+    u in [0, maxFWHM], in chunks of chunkSize configurations.
+    """
+    nConfig, nChanMax = lam2.shape
+    if chunkSize is None:
+        chunkSize = max(1, 10**7//(nSamples*nChanMax))
+    u = np.linspace(0., maxFWHM, nSamples)
+    lam2_0 = (lam2*weights).sum(axis=1)/weights.sum(axis=1)
+    sidelobe = np.empty(nConfig)
+    for start in range(0, nConfig, chunkSize):
+        stop = min(start+chunkSize, nConfig)
+        phi = fwhm[start:stop, np.newaxis]*u
+        dLam2 = lam2[start:stop] - lam2_0[start:stop, np.newaxis]
+        kernel = np.exp(-2j*phi[:, :, np.newaxis]*dLam2[:, np.newaxis, :])
+        absR = np.absolute(np.einsum('ckj,cj->ck', kernel, weights[start:stop]))
+        absR /= weights[start:stop].sum(axis=1)[:, np.newaxis]
+        # First minimum after the main lobe, then the first maximum after it
+        rising = np.diff(absR, axis=1) > 0
+        firstMin = np.argmax(rising, axis=1)
+        index = np.arange(rising.shape[1])
+        falling = ~rising & (index > firstMin[:, np.newaxis])
+        firstMax = np.argmax(falling, axis=1)
+        found = rising.any(axis=1) & falling.any(axis=1)
+        sidelobe[start:stop] = np.where(found, absR[np.arange(stop-start), firstMax], np.nan)
+    return sidelobe
+
+def planConfigs(configs):
+    """
+    Computes the RM synthesis parameters of all configurations in one
+    batch and returns them as a structured array.
+    """
+    freqList = [getChannelFreqs(config) for config in configs]
+    nChanMax = max(len(freqs) for freqs, widths in freqList)
+    lam2 = np.zeros((len(configs), nChanMax))
+    weights = np.zeros((len(configs), nChanMax))
+    minFreq = np.zeros(len(configs))
+    maxFreq = np.zeros(len(configs))
+    maxPhi = np.zeros(len(configs))
+    for i, (freqs, widths) in enumerate(freqList):
+        lam2[i, :len(freqs)] = (c/freqs)**2
+        weights[i, :len(freqs)] = 1.
+        minFreq[i], maxFreq[i] = freqs.min(), freqs.max()
+        maxPhi[i] = getMaxPhi(freqs, widths).min()
+    valid = weights > 0
+    maxLam2 = np.where(valid, lam2, -np.inf).max(axis=1)
+    minLam2 = np.where(valid, lam2, np.inf).min(axis=1)
+    fwhm = 3.8/(maxLam2 - minLam2) # from Schnitzeler et al (2008)
+    maxScale = np.pi/minLam2
+    sidelobe = getSidelobeLevels(lam2, weights, fwhm)
+    names = [getValue(config, 'name', str(i)) for i, config in enumerate(configs)]
+    nameType = 'S{}'.format(max(1, max(len(name) for name in names)))
+    table = np.zeros(len(configs), dtype=[('name', nameType), ('nChanTotal', int),
+                                          ('minFreq', float), ('maxFreq', float),
+                                          ('maxPhi', float), ('fwhm', float),
+                                          ('maxScale', float), ('sidelobe', float)])
+    table['name'] = names
+    table['nChanTotal'] = valid.sum(axis=1)
+    table['minFreq'] = minFreq/1.E6
+    table['maxFreq'] = maxFreq/1.E6
+    table['maxPhi'] = maxPhi
+    table['fwhm'] = fwhm
+    table['maxScale'] = maxScale
+    table['sidelobe'] = sidelobe
+    return table
+
+def writeTable(table, out):
+    """
+    Writes the table as whitespace-separated columns.
+    """
+    nameWidth = max(20, table.dtype['name'].itemsize)
+    out.write('# name nChanTotal minFreq[MHz] maxFreq[MHz] maxPhi[rad/m2] fwhm[rad/m2] '+
+              'maxScale[rad/m2] sidelobe\n')
+    for row in table:
+        out.write(('{:<'+str(nameWidth)+'s} {:6d} {:10.4f} {:10.4f} {:12.2f} {:10.4f} '+
+                   '{:10.4f} {:8.4f}\n').format(*row))
+
+def main(options):
+    if options.table == '':
+        raise Exception('An input configuration table must be specified.')
+    if options.sort not in COLUMNS:
+        raise Exception('Sort column must be one of {}.'.format(', '.join(COLUMNS)))
+    configs = readConfigTable(options.table)
+    if len(configs) == 0:
+        raise Exception('No configurations found in {}.'.format(options.table))
+    print 'INFO: Planning {} configurations'.format(len(configs))
+    table = planConfigs(configs)
+    table = table[np.argsort(table[options.sort], kind='mergesort')]
+    if options.reverse:
+        table = table[::-1]
+    if options.out != '':
+        with open(options.out, 'w') as f:
+            writeTable(table, f)
+    else:
+        writeTable(table, sys.stdout)
+
+if __name__ == '__main__':
+    opt = optparse.OptionParser()
+    opt.add_option('-t', '--table', help='Table of channel configurations [no default]',
+                   default='')
+    opt.add_option('-s', '--sort', help='Column to sort the output by, one of '+
+                   ', '.join(COLUMNS)+' [default: name]', default='name')
+    opt.add_option('-r', '--reverse', action='store_true', help='Sort in descending '+
+                   'order [default: False]', default=False)
+    opt.add_option('-o', '--out', help='Output file [default: print to screen]', default='')
+    options, arguments = opt.parse_args()
+    main(options)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+rmUtils.py
+
+Helpers shared by getRMSF.py, doRMSynthesis.py and rmsfCache.py.
+"""
+try:
+    import numpy as np
+except ImportError:
+    raise Exception('Unable to import Numpy.')
+
+def readColumn(fileName):
+    """
+    Reads a text file with one value per line.
+    """
+    values = []
+    with open(fileName) as f:
+        for line in f:
+            if line.strip() != '':
+                values.append(float(line))
+    return np.asarray(values)
+
+def getKernel(lam2, phiArray, lam2_0):
+    """
+    Returns the (nPhi, nChan) RM synthesis kernel exp(-2i phi (lam2 - lam2_0)).
+    """
+    return np.exp(-2j*np.outer(phiArray, np.asarray(lam2)-lam2_0))
+
+def getRMSFWidth(lam2, weights, lam2_0, nSamples=2000):
+    """
+    Returns the FWHM of the main lobe of |R(phi)| for the given weights.
+    For uniform weights this is 3.8/(max(lam2) - min(lam2)) from
+    Schnitzeler et al (2008). Otherwise |R| is sampled out to 5 times that
+    value and the half maximum is interpolated linearly between the
+    samples. Returns nan if the width is undefined.
+    """
+    lam2 = np.asarray(lam2, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    used = lam2[weights != 0]
+    if len(used) < 2 or np.amax(used) == np.amin(used):
+        return np.nan
+    fwhm = 3.8/(np.amax(used) - np.amin(used))
+    if np.all(weights == weights[0]):
+        return fwhm
+    phi  = np.linspace(0., 5*fwhm, nSamples)
+    absR = np.absolute(getKernel(lam2, phi, lam2_0).dot(weights))/weights.sum()
+    below = np.nonzero(absR < 0.5)[0]
+    if len(below) == 0:
+        return np.nan
+    k = below[0]
+    halfWidth = phi[k-1] + (absR[k-1]-0.5)/(absR[k-1]-absR[k])*(phi[k]-phi[k-1])
+    return 2*halfWidth
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+rmsfCache.py
+
+On-disk cache of RMSFs and RM synthesis kernels shared by getRMSF.py and
+doRMSynthesis.py. Entries are keyed by a hash of the lambda^2 list, the
+weights and the Faraday depth grid. The least recently used entries are
+removed once the cache grows beyond its size limit.
+"""
+import os
+import glob
+import hashlib
+import tempfile
+try:
+    import numpy as np
+except ImportError:
+    raise Exception('Unable to import Numpy.')
+from rmUtils import getKernel, getRMSFWidth
+
+DEFAULT_MAX_SIZE = 2048 # [MB]
+
+def getCacheKey(kind, lam2, weights, phiArray, lam2_0):
+    """
+    Returns a key that identifies an entry from the channel setup,
+    the weights and the Faraday depth grid.
+    """
+    md5 = hashlib.md5(kind)
+    for values in [lam2, weights, phiArray, [lam2_0]]:
+        md5.update(np.ascontiguousarray(values, dtype='<f8').tostring())
+    return md5.hexdigest()
+
+def evictCache(cacheDir, maxSize, keep=()):
+    """
+    Removes the least recently used files until the cache is smaller
+    than maxSize MB. Files listed in keep are never removed.
+    """
+    files = []
+    for name in glob.glob(os.path.join(cacheDir, '*.np[yz]')):
+        files.append((os.path.getmtime(name), os.path.getsize(name), name))
+    total = sum(entry[1] for entry in files)
+    for mtime, size, name in sorted(files):
+        if total <= maxSize*1024.**2:
+            break
+        if name in keep:
+            continue
+        os.remove(name)
+        total -= size
+
+def saveEntry(name, writeFunc):
+    """
+    Writes a cache file through a uniquely named temporary file, so that
+    other runs never see a partial entry. The temporary file is removed
+    if the write fails.
+    """
+    fd, tmpName = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(name))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            writeFunc(f)
+        finally:
+            f.close()
+        os.rename(tmpName, name)
+    except:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+
+def getCachedRMSF(cacheDir, lam2, weights, phiArray, lam2_0, rmsfFunc,
+                  maxSize=DEFAULT_MAX_SIZE, keep=(), method='direct'):
+    """
+    Returns the RMSF on phiArray with its FWHM and maximum scale. The RMSF
+    is computed with rmsfFunc() and stored in cacheDir if no entry exists.
+    method names the way rmsfFunc computes the RMSF and is part of the key.
+    Other entries used by the caller must be listed in keep, so that they
+    are not evicted.
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    name = os.path.join(cacheDir, getCacheKey('rmsf-'+method, lam2, weights, phiArray,
+                                              lam2_0)+'.npz')
+    if os.path.exists(name):
+        os.utime(name, None)
+        with np.load(name) as entry:
+            return entry['rmsf'], entry['fwhm'][()], entry['maxScale'][()]
+    rmsf = rmsfFunc()
+    fwhm = getRMSFWidth(lam2, weights, lam2_0)
+    maxScale = np.pi/np.amin(lam2)
+    saveEntry(name, lambda f: np.savez(f, rmsf=rmsf, fwhm=fwhm, maxScale=maxScale))
+    evictCache(cacheDir, maxSize, keep=[name]+list(keep))
+    return rmsf, fwhm, maxScale
+
+def getCachedKernel(cacheDir, lam2, phiArray, lam2_0, maxSize=DEFAULT_MAX_SIZE, keep=()):
+    """
+    Returns the name of a .npy file holding the (nPhi, nChan) kernel
+    exp(-2i phi (lam2 - lam2_0)), computing and storing it if needed.
+    The file can be memory-mapped by several processes. Other entries
+    used by the caller must be listed in keep.
+    """
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    name = os.path.join(cacheDir, getCacheKey('kernel', lam2, [], phiArray, lam2_0)+'.npy')
+    if os.path.exists(name):
+        os.utime(name, None)
+        return name
+    kernel = getKernel(lam2, phiArray, lam2_0)
+    saveEntry(name, lambda f: np.save(f, kernel))
+    evictCache(cacheDir, maxSize, keep=[name]+list(keep))
+    return name
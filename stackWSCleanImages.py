@@ -6,16 +6,58 @@ import os
 import numpy as np
 import math
 
-def checkBeamSize(imList):
-   # Get the beam sizes of each image
-   bmaj = []; bmin = []; bpa = []
+BITPIX_TYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+def getImageIndex(imList):
+   """
+   Reads the header of each image once and returns a list of entries with
+   the header, beam and the layout of the data section. BLANK is only
+   kept for integer images.
+   """
+   index = []
    for im in imList:
-      bmaj.append(pf.open(im)[0].header['BMAJ']*3600.)
-      bmin.append(pf.open(im)[0].header['BMIN']*3600.)
-      bpa.append(pf.open(im)[0].header['BPA'])
-   bmaj = np.asarray(bmaj)
-   bmin = np.asarray(bmin)
-   bpa  = np.asarray(bpa)
+      hduList = pf.open(im, memmap=True)
+      header = hduList[0].header
+      shape = tuple(header['NAXIS{}'.format(i)] for i in range(header['NAXIS'], 0, -1))
+      index.append({'name': im, 'header': header, 'shape': shape,
+                    'offset': hduList.fileinfo(0)['datLoc'],
+                    'dtype': np.dtype(BITPIX_TYPES[header['BITPIX']]),
+                    'bscale': header.get('BSCALE', 1.), 'bzero': header.get('BZERO', 0.),
+                    'blank': header.get('BLANK') if header['BITPIX'] > 0 else None,
+                    'bmaj': header['BMAJ']*3600., 'bmin': header['BMIN']*3600.,
+                    'bpa': header['BPA']})
+      hduList.close()
+   return index
+
+def getImageData(entry):
+   """
+   Returns a read-only memory map of the 2D image plane of an index entry.
+   """
+   data = np.memmap(entry['name'], dtype=entry['dtype'], mode='r',
+                    offset=entry['offset'], shape=entry['shape'])
+   return data.reshape(entry['shape'][-2:])
+
+def iterImageBlocks(entry, blockSize):
+   """
+   Yields (start row, scaled float64 block) for blocks of blockSize rows.
+   Pixels equal to BLANK are returned as NaN.
+   """
+   data = getImageData(entry)
+   for start in range(0, data.shape[0], blockSize):
+      raw = data[start:start+blockSize]
+      block = np.asarray(raw, dtype=np.float64)
+      if entry['bscale'] != 1. or entry['bzero'] != 0.:
+         block = block*entry['bscale'] + entry['bzero']
+      if entry['blank'] is not None:
+         block[raw == entry['blank']] = np.nan
+      yield start, block
+   del data
+
+def checkBeamSize(index):
+   # Get the beam sizes of each image
+   bmaj = np.asarray([entry['bmaj'] for entry in index])
+   bmin = np.asarray([entry['bmin'] for entry in index])
+   bpa  = np.asarray([entry['bpa'] for entry in index])
    bmajFlag = [x == bmaj[0] for x in bmaj]
    bminFlag = [x == bmin[0] for x in bmin]
    bpaFlag = [x == bpa[0] for x in bpa]
@@ -34,50 +76,75 @@ def convolImages(imList, maxBeamSize):
       os.system('rm -r temp.im temp.conv')
    return outNames
 
-def getImageNoise(imList):
+def getImageNoise(index, blockSize=256):
+   """
+   Returns the standard deviation of the negative pixels of each image.
+   The statistics of each row block are merged with the parallel variance
+   update, so only one block is held in memory.
+   """
    print 'INFO: Estimating noise in the input images'
-   noise = []; tempNoise = []
-   for im in imList:
-      thisData = np.squeeze(pf.open(im)[0].data).ravel()
-      thisData = thisData[thisData<0]
-      noise.append(np.std(thisData))
+   noise = []
+   for entry in index:
+      count = 0; mean = 0.; M2 = 0.
+      for start, block in iterImageBlocks(entry, blockSize):
+         block = block[block<0]
+         if len(block) == 0: continue
+         blockMean = block.mean()
+         blockM2 = np.square(block - blockMean).sum()
+         delta = blockMean - mean
+         total = count + len(block)
+         mean += delta*len(block)/total
+         M2 += blockM2 + delta**2*count*len(block)/total
+         count = total
+      noise.append(np.sqrt(M2/count) if count > 0 else np.nan)
    return noise
 
-def getWeightedSum(imList, noise):
+def getWeightedSum(index, noise, blockSize=256):
+   """
+   Streams each image once in row blocks and accumulates the weighted sum
+   in a single output plane.
+   """
    weights = 0
-   weightedSum = 0
-   for i, im in enumerate(imList):
-      weightedSum += (np.squeeze(pf.open(im)[0].data) * (noise[i]**2))
+   weightedSum = np.zeros(index[0]['shape'][-2:])
+   for i, entry in enumerate(index):
+      if entry['shape'][-2:] != weightedSum.shape:
+         raise Exception('Image {} has a different shape.'.format(entry['name']))
+      for start, block in iterImageBlocks(entry, blockSize):
+         weightedSum[start:start+block.shape[0]] += block * (noise[i]**2)
       weights += noise[i]**2
-   return weightedSum/weights
+   weightedSum /= weights
+   return weightedSum
 
 def main(options):
    imList = sorted(glob.glob(options.inms))
    if len(imList) == 0: raise Exception('No input fits images!')
+   blockSize = int(options.blockSize)
+   # Read all headers once
+   index = getImageIndex(imList)
    # Check if the input images have the same beam.
    # if they have different beam sizes, convolve to a common resolution
-   if not checkBeamSize(imList):
+   if not checkBeamSize(index):
       print 'INFO: Images have different beam shapes'
-      bmaj = []
-      for im in imList:
-         bmaj.append(pf.open(im)[0].header['BMAJ']*3600.)
-      bmaj = np.asarray(bmaj)
+      bmaj = np.asarray([entry['bmaj'] for entry in index])
       maxBeamSize = np.ceil(np.max(bmaj))
       print 'INFO: Convolving to a common resolution of {} arcsec'.format(maxBeamSize)
       imList = convolImages(imList, maxBeamSize)
+      index = getImageIndex(imList)
    # Get noise in each image
-   noise = getImageNoise(imList)
+   noise = getImageNoise(index, blockSize)
    print 'Noise is', noise
    # Now compute the weighted sum
-   stackedImage = getWeightedSum(imList, noise)
+   stackedImage = getWeightedSum(index, noise, blockSize)
    # Write the image to disk
-   head = pf.open(imList[0])[0].header
-   hdu = pf.PrimaryHDU(data=stackedImage, header=head)
+   head = index[0]['header']
+   hdu = pf.PrimaryHDU(data=stackedImage.astype(np.float32), header=head)
    hdu.writeto('stackedImage.fits', clobber=True)
    del hdu
 
 if __name__ == '__main__':
    opt = optparse.OptionParser()
    opt.add_option('-i', '--inms', help='Glob string for input images', default='')
+   opt.add_option('-b', '--blockSize', help='Number of image rows read at a time [default: 256]',
+                  default='256')
    options, arguments = opt.parse_args()
    main(options)